@@ -1,25 +1,65 @@
+import functools
 import pathlib
 import tkinter as tk
 
 from config import Config
 from controller import MainController
+from export import ColumnarStore
 from gui import MainWindow
 from instrument import DSA815
+from logbook import LogFile
+from pipeline import Pipeline
+from replay import ReplayInstrument
+from shm import ProcessModel
+from storage import MarkerStore, TraceStore
+from streaming import StreamServer
+from trigger import TraceTrigger
+from vectoranalyzerRS import RSVectorAnalyser
 
 wd = pathlib.Path(__file__).parent.parent
 cfile = wd / "settings.cfg"
 sfolder = wd / "QCMGUI"
 
+ANALYSERS = {
+    "DSA815": DSA815,
+    "RSVectorAnalyser": RSVectorAnalyser,
+    "Replay": ReplayInstrument,
+}
+
 
 def main():
     """Main entrypoint."""
     conf = Config(cfile)
     dfolder = wd / conf.get("data_folder")
 
+    pipeline = Pipeline()
+    pipeline.subscribe(MarkerStore(dfolder))
+    trigger = TraceTrigger(
+        pre=conf.get("trigger_pre"),
+        post=conf.get("trigger_post"),
+        step=conf.get("trigger_step"),
+        slope=conf.get("trigger_slope"),
+    )
+    pipeline.subscribe(TraceStore(dfolder, trigger=trigger))
+    pipeline.subscribe(LogFile(dfolder / "logs" / "qcm.log"))
+    if int(conf.get("columnar")):
+        pipeline.subscribe(ColumnarStore(dfolder / "columnar"))
+    if int(conf.get("stream")):
+        pipeline.subscribe(StreamServer(conf.get("stream_address")))
+
+    analyser = ANALYSERS[conf.get("analyser")]
+    if analyser is ReplayInstrument:
+        analyser = functools.partial(
+            ReplayInstrument, wd / conf.get("replay_folder"), float(conf.get("replay_speed"))
+        )
+
     root = tk.Tk()
-    app = MainWindow(root, conf, sfolder)
-    model = DSA815(dfolder)
-    ctrl = MainController(model=model, app=app)
+    app = MainWindow(root, conf, sfolder, dfolder=dfolder)
+    if int(conf.get("acquisition_process")):
+        model = ProcessModel(analyser)
+    else:
+        model = analyser()
+    ctrl = MainController(model=model, app=app, pipeline=pipeline)
     ctrl.start()  # start the controller thread
     root.mainloop()  # start the GUI thread
 
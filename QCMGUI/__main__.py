@@ -1,3 +1,4 @@
 from __init__ import main
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
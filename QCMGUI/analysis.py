@@ -0,0 +1,60 @@
+"""
+Resonance analysis of frequency sweeps, shared by live tracking and
+offline reanalysis.
+"""
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+
+class Peak(NamedTuple):
+    """A resonance located in a sweep."""
+    freq: float  # peak frequency
+    width: float  # full width at half maximum
+    height: float  # peak value above the baseline
+    snr: float  # height over baseline noise
+
+
+def find_peak(x, y, min_snr=5) -> Optional[Peak]:
+    """
+    Locate the main resonance of a sweep.
+
+    The peak frequency is refined with a parabola through the maximum and
+    its neighbours, and the half maximum crossings are linearly
+    interpolated. Returns None if there is no clear peak or if it is cut
+    by the edge of the sweep.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(y) < 3 or len(x) != len(y):
+        return None
+
+    imax = int(np.argmax(y))
+    baseline = float(np.median(y))
+    height = float(y[imax]) - baseline
+    noise = 1.4826 * float(np.median(np.abs(y - baseline)))  # MAD estimate
+    snr = height / noise if noise > 0 else np.inf
+    if height <= 0 or snr < min_snr:
+        return None
+
+    # half maximum crossings either side of the peak
+    half = baseline + height / 2
+    below = y < half
+    left = np.nonzero(below[:imax])[0]
+    right = np.nonzero(below[imax:])[0]
+    if not len(left) or not len(right):
+        return None
+    il = left[-1]
+    ir = imax + right[0]
+    xl = np.interp(half, (y[il], y[il + 1]), (x[il], x[il + 1]))
+    xr = np.interp(half, (y[ir], y[ir - 1]), (x[ir], x[ir - 1]))
+
+    # sub-bin peak position
+    freq = x[imax]
+    if 0 < imax < len(y) - 1:
+        y0, y1, y2 = y[imax - 1:imax + 2]
+        denom = y0 - 2 * y1 + y2
+        if denom != 0:
+            freq += 0.5 * (y0 - y2) / denom * (x[imax + 1] - x[imax])
+
+    return Peak(float(freq), float(xr - xl), height, float(snr))
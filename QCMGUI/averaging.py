@@ -0,0 +1,117 @@
+"""
+Host-side averaging and decimation of sweeps, to trade a faster, noisier
+instrument setting for averaging on the computer.
+"""
+from typing import Optional, Tuple
+
+import numpy as np
+
+MODES = ("running", "block", "exponential")
+
+
+class TraceAverager():
+    """
+    Average the last `n` sweeps of a window and decimate the result.
+
+    In `running` mode every sweep yields the mean of the last `n` sweeps,
+    kept as a preallocated ring and a running sum, so the cost per sweep is
+    O(points) for any `n`. In `block` mode a mean is only returned once
+    every `n` sweeps. In `exponential` mode sweeps are weighted by
+    `alpha`, 2 / (n + 1) unless given. The averaged sweep is decimated by
+    taking the mean of every `decimate` points. The average restarts
+    whenever the frequency range of the sweep changes.
+    """
+    def __init__(self, n=1, mode="running", alpha=None, decimate=1):
+        if mode not in MODES:
+            raise ValueError(f"Averaging mode should be one of {', '.join(MODES)}.")
+        self.n = max(1, int(n))
+        self.mode = mode
+        self.alpha = alpha if alpha else 2 / (self.n + 1)
+        self.decimate = max(1, int(decimate))
+
+        self.ring = None  # last n sweeps, running mode
+        self.sum = None  # sum of the sweeps in the ring or block, or the exponential average
+        self.index = 0  # next ring row
+        self.count = 0  # sweeps in the current average
+        self.key = None  # frequency range of the averaged sweeps
+
+    @property
+    def active(self) -> bool:
+        """Whether sweeps are modified at all."""
+        return self.n > 1 or self.decimate > 1
+
+    def reset(self):
+        """Forget previous sweeps."""
+        self.index = 0
+        self.count = 0
+        if self.sum is not None:
+            self.sum[:] = 0
+
+    def allocate(self, points):
+        """Preallocate buffers for a sweep length."""
+        if self.mode == "running":
+            self.ring = np.zeros((self.n, points))
+        self.sum = np.zeros(points)
+        self.index = 0
+        self.count = 0
+
+    def add(self, x, y) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Add a sweep, returning the averaged and decimated sweep if one is due."""
+        if not self.active:
+            return x, y
+        y = np.asarray(y, dtype=np.float64)
+        key = (len(y), x[0], x[-1]) if x is not None and len(x) else (len(y), )
+        if self.sum is None or len(self.sum) != len(y):
+            self.allocate(len(y))
+        elif key != self.key:
+            self.reset()
+        self.key = key
+
+        if self.mode == "running":
+            mean = self._running(y)
+        elif self.mode == "block":
+            mean = self._block(y)
+        else:
+            mean = self._exponential(y)
+        if mean is None:
+            return None
+        return self.reduce(x), self.reduce(mean)
+
+    def _running(self, y):
+        row = self.ring[self.index]
+        if self.count == self.n:
+            self.sum -= row
+        else:
+            self.count += 1
+        row[:] = y
+        self.sum += y
+        self.index = (self.index + 1) % self.n
+        if self.index == 0:
+            # recompute now and then so rounding errors cannot accumulate
+            np.sum(self.ring[:self.count], axis=0, out=self.sum)
+        return self.sum / self.count
+
+    def _block(self, y):
+        self.sum += y
+        self.count += 1
+        if self.count < self.n:
+            return None
+        mean = self.sum / self.count
+        self.reset()
+        return mean
+
+    def _exponential(self, y):
+        if self.count == 0:
+            self.sum[:] = y
+        else:
+            self.sum += self.alpha * (y - self.sum)
+        self.count += 1
+        return self.sum.copy()
+
+    def reduce(self, values):
+        """Mean of every `decimate` points, dropping any remainder."""
+        if values is None or self.decimate == 1:
+            return values
+        values = np.asarray(values)
+        size = len(values) // self.decimate * self.decimate
+        return values[:size].reshape(-1, self.decimate).mean(axis=1)
@@ -0,0 +1,55 @@
+"""
+Double-buffered hand-off of the latest sweep to the display.
+"""
+import threading
+from typing import Dict, Optional, Set, Tuple
+
+import numpy as np
+
+
+class TraceBuffer():
+    """
+    Latest sweep of each channel, in two preallocated buffers per channel.
+
+    The writer copies a sweep into the spare buffer and swaps it to the
+    front; the reader copies the front buffer into its own array. Both only
+    hold the lock for the swap or the copy, and once buffers have the
+    sweep length neither allocates. Sweeps arriving faster than the display
+    refreshes simply replace each other.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.front: Dict[int, np.ndarray] = {}
+        self.spare: Dict[int, np.ndarray] = {}
+        self.x: Dict[int, object] = {}  # frequencies of the front buffer, shared not copied
+        self.fresh: Set[int] = set()  # channels written since they were last read
+
+    def write(self, channel: int, x, y):
+        """Make a sweep the front buffer of its channel. Called by the producer."""
+        with self.lock:
+            back = self.spare.pop(channel, None)
+        if back is None or len(back) != len(y):
+            back = np.empty(len(y))
+        np.copyto(back, y)
+        with self.lock:
+            old = self.front.get(channel)
+            if old is not None:
+                self.spare[channel] = old
+            self.front[channel] = back
+            self.x[channel] = x
+            self.fresh.add(channel)
+
+    def updated(self) -> Set[int]:
+        """Channels with a new sweep since the last call."""
+        with self.lock:
+            fresh, self.fresh = self.fresh, set()
+        return fresh
+
+    def read(self, channel: int, out: Optional[np.ndarray] = None) -> Tuple[object, np.ndarray]:
+        """Copy the front buffer of a channel into `out`, reallocated only if too small."""
+        with self.lock:
+            y = self.front[channel]
+            if out is None or len(out) != len(y):
+                out = np.empty(len(y))
+            np.copyto(out, y)
+            return self.x[channel], out
@@ -1,20 +1,35 @@
 """
 All graphs needed for the live display of recorded QCM data.
+
+Charts are normally redrawn by blitting on the Tk thread. Given a
+`RenderWorker`, they are instead rasterised into their Agg buffer on the
+worker thread and the Tk thread only copies the finished frame to screen.
+Axes are part of the cached background, so a frame only draws the data
+lines unless the axis limits changed.
 """
 
+import queue
+import threading
 import tkinter as tk
+import traceback
 from datetime import datetime, timedelta
-from typing import Iterable
+from typing import Iterable, List
 
+import numpy as np
 from matplotlib import style
 
 style.use("fast")
 
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
 from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
 import matplotlib.dates as mdates
 
+FRAME_POLL = 10  # ms between checks for a finished frame
+MARGIN = 0.1  # fraction of the data span added on each side of new limits
+SHRINK = 0.5  # limits are tightened once data fills less than this fraction
+
 
 class VerticalNavigationToolbar2Tk(NavigationToolbar2Tk):
     """Overridden regular toolbar to make it vertical."""
@@ -38,12 +53,61 @@ class VerticalNavigationToolbar2Tk(NavigationToolbar2Tk):
         pass
 
 
+class LockedCanvasTkAgg(FigureCanvasTkAgg):
+    """Tk canvas whose full redraws wait for any frame rendering on a worker."""
+    def __init__(self, figure, master):
+        self.lock = threading.RLock()
+        super().__init__(figure, master)
+
+    def draw(self):
+        with self.lock:
+            super().draw()
+
+
+class RenderWorker(threading.Thread):
+    """Thread rasterising chart frames away from the Tk main loop."""
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.name = "RenderWorker"
+        self.jobs = queue.Queue()
+        self.start()
+
+    def submit(self, chart):
+        """Render a frame of a chart."""
+        self.jobs.put(chart)
+
+    def run(self):
+        while True:
+            chart = self.jobs.get()
+            if chart is None:
+                break
+            try:
+                chart.render()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                chart.rendered.set()
+
+    def close(self):
+        """Stop after any queued frames."""
+        self.jobs.put(None)
+
+
 class Chart(tk.Frame):
     """Base chart class from tk.Frame with MPL graph and toolbar."""
-    def __init__(self, parent, *args, xlabel=None, ylabel=None, **kwargs):
+    def __init__(
+        self,
+        parent,
+        *args,
+        xlabel=None,
+        ylabel=None,
+        worker: RenderWorker = None,
+        **kwargs,
+    ):
         """
         Initialize the chart.
-        Names for the labels are parameters.
+        Names for the labels are parameters. If a render `worker` is
+        given, frames are rasterised on it.
         """
         # init frame
         super().__init__(parent, *args, **kwargs)
@@ -65,7 +129,7 @@ class Chart(tk.Frame):
         self.plot.add_line(self.line)
 
         # init mpl tk backend
-        self.canvas = FigureCanvasTkAgg(self.figure, self)
+        self.canvas = LockedCanvasTkAgg(self.figure, self)
         self.canvas.draw()
 
         self.toolbar = VerticalNavigationToolbar2Tk(self.canvas, self)
@@ -81,8 +145,13 @@ class Chart(tk.Frame):
         self._artists = []
         self.cid = self.canvas.mpl_connect("draw_event", self.on_draw)
         self.add_artist(self.line)
-        self.add_artist(self.plot.xaxis)
-        self.add_artist(self.plot.yaxis)
+        self.stale = False  # limits or legend changed, the background must be redrawn
+
+        # threaded rendering
+        self.worker = worker
+        self.busy = False  # a frame is being rendered, data must not change
+        self.rendered = threading.Event()
+        self.skipped = 0  # frames skipped because rendering fell behind
 
     def add_artist(self, art):
         """Add an artist to be animated."""
@@ -106,12 +175,39 @@ class Chart(tk.Frame):
         for a in self._artists:
             fig.draw_artist(a)
 
+    def set_limits(self, xlim=None, ylim=None):
+        """Change axis limits, redrawing the axes with the next frame."""
+        with self.canvas.lock:
+            if xlim is not None:
+                self.plot.set_xlim(*xlim)
+            if ylim is not None:
+                self.plot.set_ylim(*ylim)
+            self.stale = True
+
+    def autoscale_y(self, low: float, high: float):
+        """
+        Fit the y limits to data between `low` and `high` with hysteresis:
+        limits only change when the data leaves them, or fills less than
+        `SHRINK` of them, and are then padded by `MARGIN` on each side.
+        """
+        bottom, top = self.plot.get_ylim()
+        if bottom <= low and high <= top and high - low >= SHRINK * (top - bottom):
+            return
+        pad = MARGIN * (high - low) or MARGIN * abs(high) or 1
+        self.set_limits(ylim=(low - pad, high + pad))
+
     def update_plot(self):
-        """Update the plot through blitting."""
+        """Update the plot through blitting, or a full redraw if limits changed."""
+        if self.worker:
+            self.request_frame()
+            return
         cv = self.canvas
         fig = self.figure
+        if self.stale:
+            self.stale = False
+            cv.draw()  # axes and background, then the animated artists
         # paranoia in case we missed the draw event,
-        if self._bg is None:
+        elif self._bg is None:
             self.on_draw(None)
         else:
             # restore the background
@@ -123,6 +219,36 @@ class Chart(tk.Frame):
         # let the GUI event loop process anything it has to do
         cv.flush_events()
 
+    def request_frame(self):
+        """Have the worker render a frame, unless it is still busy with the last one."""
+        if self.busy:
+            self.skipped += 1
+            return
+        self.busy = True
+        self.rendered.clear()
+        self.worker.submit(self)
+        self.after(FRAME_POLL, self.show_frame)
+
+    def render(self):
+        """Rasterise the figure into the Agg buffer. Runs in the worker thread."""
+        cv = self.canvas
+        with cv.lock:
+            if self._bg is None or self.stale:
+                self.stale = False
+                FigureCanvasAgg.draw(cv)  # full draw, without touching Tk
+            else:
+                cv.restore_region(self._bg)
+                self._draw_animated()
+
+    def show_frame(self):
+        """Copy a finished frame to the screen, on the main thread."""
+        if not self.rendered.is_set():
+            self.after(FRAME_POLL, self.show_frame)
+            return
+        with self.canvas.lock:
+            self.canvas.blit()
+        self.busy = False
+
     def set_data(self, x: Iterable, y: Iterable):
         """Set all data. To be overridden in various sublasses."""
 
@@ -149,15 +275,15 @@ class TraceChart(Chart):
         self.xdata = x
         self.ydata = y
         self.line.set_data(self.xdata, self.ydata)
-        self.plot.set_xlim(self.xdata[0], self.xdata[-1])
+        xlim = (float(self.xdata[0]), float(self.xdata[-1]))
+        if self.plot.get_xlim() != xlim:
+            self.set_limits(xlim=xlim)
 
-        mn = min(self.ydata)
-        mx = max(self.ydata)
-        xmx = x[y.index(mx)]
-
-        mn = 1.1 * mn if mn < 0 else 0.9 * mn
-        mx = 0.9 * mx if mx < 0 else 1.1 * mx
-        self.plot.set_ylim(mn, mx)
+        imx = int(np.argmax(self.ydata))
+        mn = float(np.min(self.ydata))
+        mx = float(self.ydata[imx])
+        xmx = x[imx]
+        self.autoscale_y(mn, mx)
 
         self.markx = [xmx, xmx]
         self.markline.set_data(self.markx, self.marky)
@@ -178,7 +304,12 @@ class MarkerChart(Chart):
         self.miny = 9975000  # default minimum frequency on y scale
         self.maxy = 10010000  # default maximum frequency on y scale
 
-        self.plot.set_xlim(0, 0.005)
+        # one series per harmonic, overtones are displayed as f/n
+        self.xdata = {1: []}
+        self.ydata = {1: []}
+        self.lines = {1: self.line}
+
+        self.set_limits(xlim=(0, 0.005))
         self.plot.xaxis.set_major_locator(mdates.MinuteLocator(interval=10))
         self.plot.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
 
@@ -186,43 +317,95 @@ class MarkerChart(Chart):
         """Set the graph frequency limits."""
         self.miny = miny
         self.maxy = maxy
-        self.plot.set_ylim(self.miny, self.maxy)
-
-    def append_data(self, x: datetime, y: float):
-        """Append the new frequency max to all measurements."""
-        if self.xdata:
-            first = self.xdata[0]
-            last = self.xdata[-1]
-            dtime = (last - first).seconds / 60
-
-            if dtime > self.maxt:  # cut a third of the arrays
-
-                cut = int(len(self.xdata) / 3)
-                self.xdata = self.xdata[cut:]
-                self.ydata = self.ydata[cut:]
-
-            last = self.xdata[-1]
-            first = self.displast
-            dtime = (last - first).seconds / 60
-            if dtime > self.dispt:  # rescale display
+        self.set_limits(ylim=(self.miny, self.maxy))
+
+    def series(self, channel: int):
+        """Data and line of a harmonic, created on first use."""
+        if channel not in self.lines:
+            line = Line2D([], [], color=f"C{len(self.lines)}", linewidth=0.8)
+            self.plot.add_line(line)
+            self.add_artist(line)
+            self.lines[channel] = line
+            self.xdata[channel] = []
+            self.ydata[channel] = []
+            self.plot.legend(
+                handles=list(self.lines.values()),
+                labels=[f"n={n}" for n in self.lines],
+                loc="upper left",
+            )
+            self.stale = True
+        return self.xdata[channel], self.ydata[channel], self.lines[channel]
+
+    def load(self, x, y, channel: int = 1):
+        """Fill a harmonic with previous data, e.g. restored from file, ending with a gap."""
+        x = np.asarray(x, dtype='datetime64[us]')
+        if not len(x):
+            return
+        xdata, ydata, line = self.series(channel)
+        y = np.asarray(y, dtype=float) / channel
+        xdata[:] = x.astype(object).tolist() + [x[-1].astype(object)]
+        ydata[:] = y.tolist() + [float('nan')]
+        line.set_data(xdata, ydata)
+
+        last = xdata[-1]
+        if self.displast is None or last > self.displast + timedelta(minutes=self.dispt):
+            self.displast = max(xdata[0], last - timedelta(minutes=self.dispt / 2))
+            self.set_limits(xlim=(self.displast, self.displast + timedelta(minutes=self.dispt)))
+
+        finite = y[np.isfinite(y)]
+        if len(finite):
+            self.set_ylim(
+                min(self.miny, 0.99999 * finite.min()),
+                max(self.maxy, 1.00001 * finite.max()),
+            )
+
+    def add_gap(self, x: datetime):
+        """Break all lines at a gap in the data."""
+        for channel in self.lines:
+            self.append_data(x, float('nan'), channel)
+
+    def append_data(self, x: datetime, y: float, channel: int = 1):
+        """Append the new frequency max of a harmonic to all measurements."""
+        self.append_many([x], [y], channel)
+
+    def append_many(self, x: List[datetime], y: Iterable[float], channel: int = 1):
+        """
+        Append a batch of frequency readings of a harmonic, in time order.
+        Limits are checked and the line updated once for the whole batch.
+        """
+        if not len(x):
+            return
+        xdata, ydata, line = self.series(channel)
+        y = np.asarray(y, dtype=float) / channel
+
+        if xdata and (xdata[-1] - xdata[0]).total_seconds() / 60 > self.maxt:
+            cut = int(len(xdata) / 3)  # cut a third of the arrays
+            del xdata[:cut]
+            del ydata[:cut]
+
+        last = x[-1]
+        if self.displast is None:
+            self.displast = x[0]
+            self.set_limits(xlim=(self.displast, self.displast + timedelta(minutes=self.dispt)))
+        if (last - self.displast).total_seconds() / 60 > self.dispt:  # rescale display
+            while (last - self.displast).total_seconds() / 60 > self.dispt:
                 self.displast = self.displast + timedelta(minutes=self.dispt / 2)
-                self.plot.set_xlim(self.displast, self.displast + timedelta(minutes=self.dispt))
-
-        else:
-            self.displast = x
-            self.plot.set_xlim(x, x + timedelta(minutes=self.dispt))
-
-        self.xdata.append(x)
-        self.ydata.append(y)
-
-        rescale = False
-        if min(self.ydata) < self.miny:
-            rescale = True
-            self.miny = 0.99999 * min(self.ydata)
-        if max(self.ydata) > self.maxy:
-            rescale = True
-            self.maxy = 1.00001 * max(self.ydata)
-        if rescale:
-            self.plot.set_ylim(self.miny, self.maxy)
-
-        self.line.set_data(self.xdata, self.ydata)
+            self.set_limits(xlim=(self.displast, self.displast + timedelta(minutes=self.dispt)))
+
+        xdata.extend(x)
+        ydata.extend(y.tolist())
+
+        finite = y[np.isfinite(y)]
+        if len(finite):
+            low, high = finite.min(), finite.max()
+            rescale = False
+            if low < self.miny:
+                rescale = True
+                self.miny = 0.99999 * low
+            if high > self.maxy:
+                rescale = True
+                self.maxy = 1.00001 * high
+            if rescale:
+                self.set_limits(ylim=(self.miny, self.maxy))
+
+        line.set_data(xdata, ydata)
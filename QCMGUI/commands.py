@@ -0,0 +1,121 @@
+"""
+Typed control commands sent from the GUI to the instrument.
+
+Each command knows which instrument method it maps to, so the controller
+can run it without looking up methods by name. Stop commands have
+`CONTROL` priority: they are cheap, and the controller runs them on their
+own lane so they never wait behind a slow connection or configuration.
+Start commands stay in order behind the connection and configuration
+they depend on.
+"""
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+CONTROL = 0  # stop commands, handled immediately
+NORMAL = 1  # commands which talk to the instrument
+
+
+@dataclass
+class Command():
+    """Base class for a control command."""
+    priority = NORMAL
+
+    def apply(self, model):
+        """Run the command on the instrument model."""
+        raise NotImplementedError
+
+
+@dataclass
+class QueryInstruments(Command):
+    """List available VISA resources."""
+    def apply(self, model):
+        model.query_instruments()
+
+
+@dataclass
+class Connect(Command):
+    """Connect to a VISA resource."""
+    instrument: str
+
+    def apply(self, model):
+        model.connect(self.instrument)
+
+
+@dataclass
+class Configure(Command):
+    """Prime the instrument for a frequency range and the harmonics to track."""
+    start: float
+    stop: float
+    harmonics: Tuple[int, ...] = (1, )
+    zoom: float = 0  # span as a multiple of resonance width, 0 to disable
+    average: int = 1  # sweeps averaged on the computer
+    average_mode: str = "running"  # running, block or exponential
+    decimate: int = 1  # trace points averaged into one
+    profile: Optional[Dict[str, float]] = None  # sweep parameters, e.g. from tuning
+
+    def apply(self, model):
+        model.configure(
+            start=self.start,
+            stop=self.stop,
+            harmonics=self.harmonics,
+            zoom=self.zoom,
+            average=self.average,
+            average_mode=self.average_mode,
+            decimate=self.decimate,
+            profile=self.profile,
+        )
+
+
+@dataclass
+class Tune(Command):
+    """Find the fastest sweep settings resolving the resonance to `target` Hz."""
+    target: float
+    name: str = "tuned"
+    apply_best: bool = False
+
+    def apply(self, model):
+        model.tune(self.target, self.name, self.apply_best)
+
+
+@dataclass
+class RunCmd(Command):
+    """Send a raw VISA command."""
+    cmd: str
+
+    def apply(self, model):
+        model.run_cmd(self.cmd)
+
+
+@dataclass
+class StartMeasure(Command):
+    """Start reading data."""
+
+    def apply(self, model):
+        model.start_measure()
+
+
+@dataclass
+class StopMeasure(Command):
+    """Stop reading data."""
+    priority = CONTROL
+
+    def apply(self, model):
+        model.stop_measure()
+
+
+@dataclass
+class StartRecord(Command):
+    """Start persisting read data, sweeps only around events if `triggered`."""
+    triggered: bool = False
+
+    def apply(self, model):
+        model.start_record(self.triggered)
+
+
+@dataclass
+class StopRecord(Command):
+    """Stop persisting read data."""
+    priority = CONTROL
+
+    def apply(self, model):
+        model.stop_record()
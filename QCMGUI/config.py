@@ -10,9 +10,30 @@ class Config():
         self.file = cfg_file
         self.sett = {
             "instrument": "TCPIP::127.0.0.1::HISLIP",
+            "analyser": "DSA815",
             "data_folder": "current_data",
             "start": 9920000,
             "stop": 10020000,
+            "harmonics": "1",
+            "zoom": 0,
+            "zoom_factor": 10,
+            "average": 1,
+            "average_mode": "running",
+            "decimate": 1,
+            "profile": "",  # active sweep profile, saved as profile_<name>
+            "columnar": 0,
+            "acquisition_process": 0,
+            "render_thread": 0,
+            "restore": 1,
+            "stream": 0,
+            "stream_address": "tcp://127.0.0.1:5555",
+            "trigger_record": 0,
+            "trigger_pre": 20,  # sweeps kept before a trigger
+            "trigger_post": 100,  # sweeps saved after a trigger
+            "trigger_step": 0,  # Hz between two markers, 0 is off
+            "trigger_slope": 0,  # Hz/s, 0 is off
+            "replay_folder": "recorded_data",
+            "replay_speed": 1,
         }
         self.load(self.file)
 
@@ -36,7 +57,7 @@ class Config():
                     continue
                 key, val = map(str.strip, keyvals)
 
-                if key in self.sett:
+                if key in self.sett or key.startswith("profile_"):
                     self.sett[key] = val
         except:
             pass
@@ -1,29 +1,67 @@
 """
-The controller class which executes read/write functions in a separate thread. 
+The controller class which executes read/write functions in a separate thread.
 """
 import atexit
+import datetime as dt
 import queue
 import sys
 import threading
+import time
 import traceback
 
+from commands import CONTROL, NORMAL, Command
+from pipeline import CommandLatency, LogEvent, Pipeline
+
+
+class CommandQueue():
+    """
+    Unbounded command queue with one lane per priority.
+
+    Sending never blocks the GUI. Commands are stamped on arrival, so the
+    time they spend waiting can be measured.
+    """
+    def __init__(self):
+        self.lanes = {CONTROL: queue.Queue(), NORMAL: queue.Queue()}
+
+    def put(self, cmd):
+        """Queue a command on the lane of its priority."""
+        if isinstance(cmd, Command):
+            cmd.issued = time.perf_counter()
+        self.lanes[getattr(cmd, "priority", NORMAL)].put(cmd)
+
+    def get(self, priority=NORMAL, timeout=None):
+        """Next command of a lane, raising `queue.Empty` if there is none."""
+        if timeout is None:
+            return self.lanes[priority].get_nowait()
+        return self.lanes[priority].get(timeout=timeout)
+
+    def empty(self):
+        """Whether all lanes are empty."""
+        return all(lane.empty() for lane in self.lanes.values())
+
 
 class MainController(threading.Thread):
     """Event loop for the GUI/instrument connection.
 
     This class interfaces between the GUI and the underlying
     instrument. It runs in a separate thread and uses a queue to
-    communicate tasks from the GUI to the instrument interface. This is
-    important to keep the GUI responsive.
+    communicate commands from the GUI to the instrument interface. This is
+    important to keep the GUI responsive. Data flows back from the
+    instrument through the pipeline, to which the GUI and stores subscribe.
+
+    Stop commands run on a second thread, so they take effect at once
+    even while a slow command (connection, configuration) is running. The
+    latency of every command is published as a `CommandLatency` record.
     """
-    def __init__(self, model=None, app=None):
+    def __init__(self, model=None, app=None, pipeline: Pipeline = None):
         super().__init__()
+        self.name = "MainController"
 
         # allow thread to run in background
         self.daemon = True
 
         # create a command queue
-        self.queue = queue.Queue(maxsize=10)
+        self.queue = CommandQueue()
 
         # event will be triggered to process queue
         self.queue_event = threading.Event()
@@ -33,22 +71,33 @@ class MainController(threading.Thread):
         atexit.register(self.quit_event.set)
         atexit.register(self.queue_event.set)
 
+        # thread for stop commands
+        self.thread_control = threading.Thread(
+            target=self.run_control, name="ControlCommands", daemon=True
+        )
+
+        # data pipeline
+        self.pipeline = pipeline or Pipeline()
+
         # connect model/app
         self.model = model
         self.model.set_trigger(
             queue=self.queue,
             queue_event=self.queue_event,
             quit_event=self.quit_event,
+            pipeline=self.pipeline,
         )
         self.app = app
         self.app.set_trigger(
             queue=self.queue,
             queue_event=self.queue_event,
             quit_event=self.quit_event,
+            pipeline=self.pipeline,
         )
 
     def run(self):
         """Main event loop."""
+        self.thread_control.start()
         while True:
             self.queue_event.wait()  # blocked in waiting
 
@@ -58,39 +107,50 @@ class MainController(threading.Thread):
 
             self.queue_event.clear()
 
-            while not self.queue.empty():
-                job, kwargs = self.queue.get()
-
+            while not self.quit_event.is_set():
                 try:
-                    if job == 'ctrl':
-                        func = getattr(self.model, kwargs.pop('task'))
-                    elif job == 'disp':
-                        func = getattr(self.app, kwargs.pop('task'))
-                    else:
-                        self.log(f'Unknown job type: {job}')
-                        self.log(f'Kwargs:\n{kwargs}')
-                except KeyError:
-                    self.log(f'Could not find job {job}.')
-                    self.log(f'Kwargs:\n{kwargs}')
-                    continue
-
-                try:
-                    func(**kwargs)
-                except Exception as err:
-                    traceback.print_exc()
-                    self.log(
-                        f"Error caught -> {repr(err)} while running '{job}' with parameters '{kwargs}'"
-                    )
-                    self.log(err)
+                    cmd = self.queue.get(NORMAL)
+                except queue.Empty:
+                    break
+                self.run_command(cmd)
+
+    def run_control(self):
+        """Event loop for stop commands."""
+        while not self.quit_event.is_set():
+            try:
+                cmd = self.queue.get(CONTROL, timeout=0.5)
+            except queue.Empty:
+                continue
+            self.run_command(cmd)
+
+    def run_command(self, cmd):
+        """Run a command on the model and publish its latency, unless the model times it."""
+        if not isinstance(cmd, Command):
+            self.log(f'Unknown command: {cmd}')
+            return
+
+        started = time.perf_counter()
+        try:
+            self.model.execute(cmd)
+        except Exception as err:
+            traceback.print_exc()
+            self.log(f"Error caught -> {repr(err)} while running {cmd}")
+            self.log(err)
+        finished = time.perf_counter()
+        if getattr(self.model, "reports_latency", False):
+            return  # the model measures when commands take effect
+        issued = getattr(cmd, "issued", started)
+        self.pipeline.publish(
+            CommandLatency(dt.datetime.now(), type(cmd).__name__, started - issued, finished - started)
+        )
 
     def log(self, msg):
-        """Self-add a log to the queue."""
-        self.queue.put(('disp', {'task': 'log', 'value': msg}))
-        self.queue_event.set()
+        """Publish a log message to the pipeline."""
+        self.pipeline.publish(LogEvent(dt.datetime.now(), msg))
 
     def close(self):
         """Call exit on all components then exit thread."""
-        for item in (self.model, self.app):
+        for item in (self.model, self.pipeline, self.app):
             try:
                 item.close()
             except AttributeError as ex:
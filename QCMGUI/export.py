@@ -0,0 +1,266 @@
+"""
+Columnar binary storage of a run, for fast loading in analysis.
+
+A run is stored as a folder of `.npz` partitions with typed columns:
+`time` (datetime64[us]) and `freq` (float64) for markers, and `time`,
+the frequency axes `x` (float64) and the trace matrix `y` (float32) for
+traces. An append-only `index.csv` lists the time range of every
+partition, so loading a time range only opens the partitions it overlaps.
+
+Convert a recorded run with:
+    python QCMGUI/export.py current_data [--output folder]
+
+or record directly to `<data folder>/columnar` with `columnar = 1` in
+`settings.cfg`.
+"""
+import argparse
+import pathlib
+import sys
+import warnings
+from typing import List, Tuple
+
+import numpy as np
+
+from pipeline import Gap, Marker, Sink, Trace
+from storage import parse_trace_filename
+
+INDEX = "index.csv"
+MARKER_ROW = [("time", "datetime64[us]"), ("freq", np.float64)]  # columns of a marker csv line
+
+
+class ColumnarWriter():
+    """Write partitions and keep the index up to date."""
+    def __init__(self, folder: pathlib.Path):
+        if not folder.exists():
+            folder.mkdir(parents=True)
+        self.folder = folder
+        self.count = len(read_index(folder))
+
+    def write(self, kind: str, channel: int, **columns):
+        """Write one partition of a kind ('markers' or 'traces') and channel."""
+        time = columns["time"]
+        if not len(time):
+            return
+        name = f"{kind}_n{channel}_{self.count:06d}.npz"
+        np.savez(self.folder / name, **columns)
+        self.count += 1
+        with open(self.folder / INDEX, 'a', encoding="utf8") as fp:
+            fp.write(f"{kind},{channel},{name},{time.min()},{time.max()},{len(time)}\n")
+
+    def write_markers(self, channel, time, freq):
+        """Write a partition of markers."""
+        self.write(
+            "markers",
+            channel,
+            time=np.asarray(time, dtype='datetime64[us]'),
+            freq=np.asarray(freq, dtype=np.float64),
+        )
+
+    def write_traces(self, channel, time, x, y):
+        """Write a partition of traces, one row per sweep."""
+        self.write(
+            "traces",
+            channel,
+            time=np.asarray(time, dtype='datetime64[us]'),
+            x=np.asarray(x, dtype=np.float64),
+            y=np.asarray(y, dtype=np.float32),
+        )
+
+
+class ColumnarStore(Sink):
+    """
+    Pipeline sink exporting recorded data incrementally.
+    Markers are flushed as a partition every `rows` records, with gaps
+    stored as `nan` markers on every channel. Traces are kept
+    every `trace_interval` seconds (0 for every sweep) and flushed in
+    partitions of `trace_rows`.
+    """
+    types = (Marker, Trace, Gap)
+    batch_size = 100
+    maxsize = 0
+
+    def __init__(self, folder: pathlib.Path, rows=10000, trace_rows=100, trace_interval=60):
+        self.writer = ColumnarWriter(folder)
+        self.rows = rows
+        self.trace_rows = trace_rows
+        self.trace_interval = trace_interval
+        self.markers = {}  # channel -> list of (time, freq)
+        self.traces = {}  # channel -> list of (time, x, y)
+        self.reftime = {}
+
+    def consume(self, records):
+        for rec in records:
+            if not rec.record:
+                continue
+            if isinstance(rec, Marker):
+                self.add_marker(rec.channel, rec.time, rec.freq)
+            elif isinstance(rec, Gap):
+                for channel in set(self.markers) | {1}:
+                    self.add_marker(channel, rec.time, np.nan)
+                    self.add_marker(channel, rec.end, np.nan)
+            else:
+                reftime = self.reftime.get(rec.channel)
+                if reftime and (rec.time - reftime).total_seconds() < self.trace_interval:
+                    continue
+                self.reftime[rec.channel] = rec.time
+                buffer = self.traces.setdefault(rec.channel, [])
+                buffer.append((rec.time, np.array(rec.x), np.array(rec.y)))
+                if len(buffer) >= self.trace_rows:
+                    self.flush_traces(rec.channel)
+
+    def add_marker(self, channel, time, freq):
+        """Buffer a marker, flushing if the partition is full."""
+        buffer = self.markers.setdefault(channel, [])
+        buffer.append((time, freq))
+        if len(buffer) >= self.rows:
+            self.flush_markers(channel)
+
+    def flush_markers(self, channel):
+        """Write buffered markers of a channel."""
+        buffer = self.markers.pop(channel, [])
+        if buffer:
+            time, freq = zip(*buffer)
+            self.writer.write_markers(channel, time, freq)
+
+    def flush_traces(self, channel):
+        """Write buffered traces of a channel."""
+        buffer = self.traces.pop(channel, [])
+        if buffer:
+            time, x, y = zip(*buffer)
+            self.writer.write_traces(channel, time, np.stack(x), np.stack(y))
+
+    def close(self):
+        for channel in list(self.markers):
+            self.flush_markers(channel)
+        for channel in list(self.traces):
+            self.flush_traces(channel)
+
+
+##################
+#### Reading
+##################
+
+
+def read_index(folder: pathlib.Path) -> List[Tuple[str, int, str, np.datetime64, np.datetime64]]:
+    """All partitions as (kind, channel, file, tmin, tmax)."""
+    path = folder / INDEX
+    if not path.exists():
+        return []
+    parts = []
+    with open(path, encoding="utf8") as fp:
+        for line in fp:
+            kind, channel, name, tmin, tmax, _ = line.strip().split(",")
+            parts.append((
+                kind,
+                int(channel),
+                name,
+                np.datetime64(tmin, 'us'),
+                np.datetime64(tmax, 'us'),
+            ))
+    return parts
+
+
+def partitions(folder: pathlib.Path, kind: str, channel=1, start=None, end=None) -> List[str]:
+    """Partitions of a kind and channel overlapping the [start, end] range."""
+    start = np.datetime64(start, 'us') if start is not None else None
+    end = np.datetime64(end, 'us') if end is not None else None
+    return [
+        name for pkind, pchannel, name, tmin, tmax in read_index(folder)
+        if pkind == kind and pchannel == channel and (start is None or tmax >= start) and
+        (end is None or tmin <= end)
+    ]
+
+
+def _load(folder, kind, channel, start, end, columns):
+    start = np.datetime64(start, 'us') if start is not None else None
+    end = np.datetime64(end, 'us') if end is not None else None
+    loaded = {col: [] for col in columns}
+    for name in partitions(folder, kind, channel, start, end):
+        with np.load(folder / name) as part:
+            mask = np.ones(len(part["time"]), dtype=bool)
+            if start is not None:
+                mask &= part["time"] >= start
+            if end is not None:
+                mask &= part["time"] <= end
+            for col in columns:
+                loaded[col].append(part[col][mask])
+    return [np.concatenate(loaded[col]) if loaded[col] else np.array([]) for col in columns]
+
+
+def load_markers(folder: pathlib.Path, channel=1, start=None, end=None):
+    """Marker `time` and `freq` arrays of a channel, optionally within a time range."""
+    return _load(folder, "markers", channel, start, end, ("time", "freq"))
+
+
+def load_traces(folder: pathlib.Path, channel=1, start=None, end=None):
+    """Trace `time`, `x` and `y` arrays of a channel, optionally within a time range."""
+    return _load(folder, "traces", channel, start, end, ("time", "x", "y"))
+
+
+##################
+#### Conversion
+##################
+
+
+def read_markers_csv(path: pathlib.Path):
+    """Vectorised parse of a marker csv file into time and freq arrays."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)  # empty file
+        data = np.loadtxt(path, delimiter=",", dtype=MARKER_ROW, ndmin=1, encoding="utf8")
+    return data["time"], data["freq"]
+
+
+def convert(dfolder: pathlib.Path, output: pathlib.Path = None, rows=100000, trace_rows=500):
+    """Convert the csv marker and trace files of a run to columnar storage."""
+    output = output or dfolder / "columnar"
+    if (output / INDEX).exists():
+        raise FileExistsError(f"{output} already contains an export.")
+    writer = ColumnarWriter(output)
+
+    for path in sorted(dfolder.glob("markers*.csv")):
+        stem = path.stem
+        channel = int(stem.rsplit("_n", 1)[1]) if "_n" in stem else 1
+        time, freq = read_markers_csv(path)
+        order = np.argsort(time, kind="stable")
+        for i in range(0, len(time), rows):
+            sel = order[i:i + rows]
+            writer.write_markers(channel, time[sel], freq[sel])
+        print(f"{path.name}: {len(time)} markers", file=sys.stderr)
+
+    traces = {}
+    for path in sorted((dfolder / "traces").glob("*.csv")):
+        try:
+            time, channel = parse_trace_filename(path.name)
+        except ValueError:
+            continue
+        traces.setdefault(channel, []).append((time, path))
+    for channel, files in traces.items():
+        files.sort()
+        for i in range(0, len(files), trace_rows):
+            chunk = files[i:i + trace_rows]
+            # sweeps of different lengths can't share a matrix
+            groups = {}
+            for time, path in chunk:
+                data = np.loadtxt(path, delimiter=",", ndmin=2)
+                groups.setdefault(len(data), []).append((time, data))
+            for group in groups.values():
+                writer.write_traces(
+                    channel,
+                    [time for time, _ in group],
+                    np.stack([data[:, 0] for _, data in group]),
+                    np.stack([data[:, 1] for _, data in group]),
+                )
+        print(f"traces n={channel}: {len(files)} sweeps", file=sys.stderr)
+
+
+def main():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description="Export a QCM run to columnar storage.")
+    parser.add_argument("folder", type=pathlib.Path, help="data folder of the run")
+    parser.add_argument("--output", type=pathlib.Path, help="export folder")
+    args = parser.parse_args()
+    convert(args.folder, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,75 @@
 """The graphical user interface, built in TK."""
 
+import collections
 import pathlib
 import sys
+import time
 import datetime as dt
 
 import tkinter as tk
 import tkinter.ttk as ttk
 import tkinter.messagebox as tkMessageBox
 import tkinter.scrolledtext as tkScrolledText
+import tkinter.simpledialog as tkSimpleDialog
 from typing import Iterable
 
-from chart import TraceChart, MarkerChart
+from buffers import TraceBuffer
+from chart import MarkerChart, RenderWorker, TraceChart
+from commands import (
+    Configure, Connect, QueryInstruments, RunCmd, StartMeasure, StartRecord, StopMeasure,
+    StopRecord, Tune
+)
 from config import Config
+from logbook import ConsoleSink, LogBuffer
+from pipeline import (
+    CommandLatency, Gap, LogEvent, Marker, MarkerBatch, Pipeline, ResourceList, Sink, Trace,
+    TuneResult
+)
+from profiler import ProfileSession
+from stability import StatsSink
+from storage import marker_files, read_markers_tail
+from tuning import format_profile, parse_profile
 
 NWE = tk.N + tk.W + tk.E
 PADX = 5
 PADY = 5
+LOG_LINES = 2000  # maximum lines kept in the output console
+LOG_REFRESH = 200  # ms between console updates
+STATS_REFRESH = 1000  # ms between statistics panel updates
+
+
+class DisplaySink(Sink):
+    """Pipeline sink handing records over to the main window."""
+    types = (Marker, Trace, Gap, ResourceList, CommandLatency, TuneResult)
+    batch_size = 100
+    maxsize = 1000
+    linger = 0.1  # the display only refreshes every second
+
+    def __init__(self, app):
+        self.app = app
+
+    def consume(self, records):
+        """
+        Queue records for the Tk main thread, which applies them on refresh.
+        Consecutive markers of a harmonic are queued as a single batch.
+        """
+        batches = {}  # channel -> batch still open for markers
+        pending = []
+        for rec in records:
+            if isinstance(rec, Marker):
+                batch = batches.get(rec.channel)
+                if batch is None:
+                    batch = batches[rec.channel] = MarkerBatch(rec.time, rec.channel, [], [])
+                    pending.append(batch)
+                batch.times.append(rec.time)
+                batch.freqs.append(rec.freq)
+            elif isinstance(rec, Trace):
+                if rec.x is not None and rec.y is not None:
+                    self.app.traces.write(rec.channel, rec.x, rec.y)
+            else:
+                batches.clear()  # later markers go after this record
+                pending.append(rec)
+        self.app.pending.extend(pending)
 
 
 class MainWindow(ttk.Frame):
@@ -26,25 +80,43 @@ class MainWindow(ttk.Frame):
         config: Config,
         wd: pathlib.Path,
         *args,
+        dfolder: pathlib.Path = None,
         **kwargs,
     ):
         super().__init__(parent, *args, **kwargs)
         self.config = config
         self.wd = wd
+        self.dfolder = dfolder  # data folder to restore the last session from
         self.parent = parent
 
         self.queue = None  # event queue reference
         self.queue_event = None  # event queue trigger
         self.quit_event = None  # exit event
+        self.pipeline = None  # data pipeline
+        self.pending = collections.deque(maxlen=10000)  # records waiting for display
+        self.traces = TraceBuffer()  # latest sweeps waiting for display
+        self.trace_y = None  # display copy of the latest sweep
+        self.logbuffer = LogBuffer()  # log lines waiting for display
+        self.stats = StatsSink()  # live noise statistics
+        self.stats_panel = None
+        self.latency = {}  # command name -> [count, last, total, max] in s
+        self.render_worker = RenderWorker() if int(self.config.get("render_thread")) else None
+        self.profiler = ProfileSession(dfolder or wd)
+        self.profiling = tk.BooleanVar(self)
 
         self.instruments = ("", )
         self.instrument = tk.StringVar(self)
         self.instrument.set("")
+        self.zoom = tk.BooleanVar(self)
+        self.zoom.set(bool(int(self.config.get("zoom"))))
+        self.triggered = tk.BooleanVar(self)
+        self.triggered.set(bool(int(self.config.get("trigger_record"))))
 
         self.reading = False
         self.recording = False
         self.configure_window()
         self.create_layout()
+        self.restore_markers()
 
     ##################
     #### GUI config
@@ -98,9 +170,23 @@ class MainWindow(ttk.Frame):
         menu.add_command(label='Quit', command=self.signal_close)
         mbutton['menu'] = menu
 
+        mbutton = ttk.Menubutton(self.menu_bar, text='View', underline=0)
+        mbutton.pack(side=tk.LEFT)
+        menu = tk.Menu(mbutton, tearoff=0)
+        menu.add_command(label='Noise statistics', command=self.show_stats)
+        menu.add_command(label='Command latency', command=self.show_latency)
+        mbutton['menu'] = menu
+
+        mbutton = ttk.Menubutton(self.menu_bar, text='Tools', underline=0)
+        mbutton.pack(side=tk.LEFT)
+        menu = tk.Menu(mbutton, tearoff=0)
+        menu.add_command(label='Tune sweep settings...', command=self.task_tune)
+        mbutton['menu'] = menu
+
         mbutton = ttk.Menubutton(self.menu_bar, text='Help', underline=0)
         mbutton.pack(side=tk.LEFT)
         menu = tk.Menu(mbutton, tearoff=0)
+        menu.add_checkbutton(label='Profile threads', variable=self.profiling, command=self.toggle_profiling)
         menu.add_command(label='About', command=self.about)
         mbutton['menu'] = menu
 
@@ -138,10 +224,17 @@ class MainWindow(ttk.Frame):
         self.ipt_stop.insert(0, self.config.get('stop'))
         self.ipt_stop.grid(column=2, row=1, sticky=tk.NW, padx=PADX, pady=PADY, ipadx=10)
 
+        self.ipt_harm = tk.Entry(self.ctrl_row, width=10)
+        self.ipt_harm.insert(0, self.config.get('harmonics'))
+        self.ipt_harm.grid(column=3, row=1, sticky=tk.NW, padx=PADX, pady=PADY, ipadx=10)
+
         self.btn_running = ttk.Button(self.ctrl_row)
         self.btn_running["text"] = "Prime"
         self.btn_running["command"] = self.task_configure
-        self.btn_running.grid(column=3, row=1, sticky=tk.NW, padx=PADX, pady=PADY, ipadx=10)
+        self.btn_running.grid(column=4, row=1, sticky=tk.NW, padx=PADX, pady=PADY, ipadx=10)
+
+        self.chk_zoom = ttk.Checkbutton(self.ctrl_row, text="Zoom", variable=self.zoom)
+        self.chk_zoom.grid(column=5, row=1, sticky=tk.NW, padx=PADX, pady=PADY)
 
         #
 
@@ -159,6 +252,9 @@ class MainWindow(ttk.Frame):
         self.btn_record["command"] = self.task_toggle_record
         self.btn_record.grid(column=2, row=2, sticky=tk.NW, padx=PADX, pady=PADY, ipadx=10)
 
+        self.chk_trigger = ttk.Checkbutton(self.ctrl_row, text="Triggered", variable=self.triggered)
+        self.chk_trigger.grid(column=3, row=2, sticky=tk.NW, padx=PADX, pady=PADY)
+
     def create_graph(self, row):
         """Graphs row."""
         self.chart_row = tk.Frame(self, padx=PADX, pady=PADY)
@@ -169,6 +265,7 @@ class MainWindow(ttk.Frame):
             self.chart_row,
             xlabel="Frequency [Hz]",
             ylabel="Power [mV]",
+            worker=self.render_worker,
         )
         self.plot_trace.grid(row=0, column=0, sticky=tk.NSEW)
 
@@ -179,6 +276,7 @@ class MainWindow(ttk.Frame):
             self.chart_row,
             xlabel="Time",
             ylabel="Frequency [Hz]",
+            worker=self.render_worker,
         )
         self.plot_mark.set_ylim(
             miny=float(self.config.get('start')),
@@ -219,6 +317,26 @@ class MainWindow(ttk.Frame):
         self.btn_input.grid(row=0, column=1, sticky=tk.SW, padx=PADX, pady=PADY, ipadx=10)
         self.input_row.columnconfigure(0, weight=1)
 
+    def restore_markers(self):
+        """Show the last stored hours of markers from a previous session."""
+        if not self.dfolder or not int(self.config.get("restore")):
+            return
+        start = time.perf_counter()
+        total = 0
+        for channel, path in sorted(marker_files(self.dfolder).items()):
+            try:
+                x, y = read_markers_tail(path, self.plot_mark.maxt)
+                self.plot_mark.load(x, y, channel)
+            except (OSError, ValueError) as err:
+                self.log(f"Could not restore markers from {path.name}: {repr(err)}")
+                continue
+            total += len(x)
+        if total:
+            self.log(
+                f"Restored {total} markers from the previous session "
+                f"in {time.perf_counter() - start:.2f} s."
+            )
+
     ##################
     #### Gui callbacks
     ##################
@@ -230,9 +348,38 @@ class MainWindow(ttk.Frame):
             "Record QCM over Ethernet using pyVISA \nPaul Iacomi 2021\nFor updates check https://github.com/pauliacomi/qcm-pygui"
         )
 
+    def toggle_profiling(self):
+        """Start or stop sampling the stacks of all threads."""
+        if self.profiling.get():
+            self.profiler.start()
+            self.log("Profiling all threads.")
+        elif self.profiler.running:
+            folder = self.profiler.stop()
+            self.log(f"Thread profiles written to {folder}.")
+
+    def show_stats(self):
+        """Open the noise statistics panel, or raise it if already open."""
+        if self.stats_panel and self.stats_panel.winfo_exists():
+            self.stats_panel.lift()
+        else:
+            self.stats_panel = StatsPanel(self, self.stats)
+
+    def show_latency(self):
+        """Msgbox with the time from sending each command to its completion."""
+        lines = [
+            f"{name}: last {last * 1000:.1f} ms, mean {total / count * 1000:.1f} ms, "
+            f"max {peak * 1000:.1f} ms ({count} sent)"
+            for name, (count, last, total, peak) in sorted(self.latency.items())
+        ]
+        tkMessageBox.showinfo('Command latency', "\n".join(lines) or "No commands sent yet.")
+
     def close(self):
         """Close program."""
         print("Window asked to close.")
+        if self.render_worker:
+            self.render_worker.close()
+        if self.profiler.running:
+            self.profiler.stop()
         self.parent.quit()
         print("Window closed.")
 
@@ -252,7 +399,7 @@ class MainWindow(ttk.Frame):
         cmd = self.ipt_visa.get()
         self.ipt_visa.delete(0, tk.END)
 
-        self.queue.put(('ctrl', {'task': 'run_cmd', 'cmd': cmd}))
+        self.queue.put(RunCmd(cmd))
         self.queue_event.set()
 
         self.log(f"Command sent: \"{cmd}\".")
@@ -261,16 +408,68 @@ class MainWindow(ttk.Frame):
         """Send a task to the controller that configures the instrument."""
         start = float(self.ipt_start.get())
         stop = float(self.ipt_stop.get())
+        try:
+            harmonics = tuple(int(n) for n in self.ipt_harm.get().split(',') if n.strip())
+            if not harmonics or min(harmonics) < 1:
+                raise ValueError
+        except ValueError:
+            self.log("Harmonics should be a list of positive integers, e.g. '1,3,5'.")
+            return
         self.config.set('start', start)
         self.config.set('stop', stop)
+        self.config.set('harmonics', ','.join(map(str, harmonics)))
+        self.config.set('zoom', int(self.zoom.get()))
+        zoom = float(self.config.get('zoom_factor')) if self.zoom.get() else 0
         self.plot_mark.set_ylim(start, stop)
-        self.queue.put(('ctrl', {'task': 'configure', 'start': start, 'stop': stop}))
+        self.queue.put(
+            Configure(
+                start,
+                stop,
+                harmonics,
+                zoom,
+                average=int(self.config.get('average')),
+                average_mode=self.config.get('average_mode'),
+                decimate=int(self.config.get('decimate')),
+                profile=self.profile(),
+            )
+        )
+        self.queue_event.set()
+
+    def profile(self):
+        """The active sweep profile, if any."""
+        name = self.config.get('profile')
+        value = self.config.get(f'profile_{name}') if name else None
+        return parse_profile(value) if value else None
+
+    def task_tune(self):
+        """Ask for a target resolution and send a tuning task to the controller."""
+        target = tkSimpleDialog.askfloat(
+            "Tune sweep settings",
+            "Required peak frequency resolution [Hz]:",
+            parent=self,
+            minvalue=0,
+        )
+        if not target:
+            return
+        name = tkSimpleDialog.askstring(
+            "Tune sweep settings",
+            "Profile name:",
+            initialvalue=self.config.get('profile') or "tuned",
+            parent=self,
+        )
+        if not name:
+            return
+        apply_best = tkMessageBox.askyesno(
+            "Tune sweep settings", "Apply the best setting when tuning is done?", parent=self
+        )
+        self.queue.put(Tune(target, name.strip().replace(" ", "_"), apply_best))
         self.queue_event.set()
+        self.log("Tuning started, this may take a few minutes.")
 
     def task_connect(self):
         """Send a task to the controller that connects to the instrument."""
         instrument = self.instrument.get()
-        self.queue.put(('ctrl', {'task': 'connect', 'instrument': instrument}))
+        self.queue.put(Connect(instrument))
         self.queue_event.set()
 
         self.log(f"Connecting to {instrument}.")
@@ -282,12 +481,12 @@ class MainWindow(ttk.Frame):
     def task_toggle_read(self):
         """Send a task to the controller that toggles whether the data is read or not."""
         if self.reading:
-            self.queue.put(('ctrl', {'task': 'stop_measure'}))
+            self.queue.put(StopMeasure())
             self.btn_acquire["text"] = "Read Start"
             self.reading = False
             self.log("Stopped reading.")
         else:
-            self.queue.put(('ctrl', {'task': 'start_measure'}))
+            self.queue.put(StartMeasure())
             self.btn_acquire["text"] = "Read Stop"
             self.reading = True
             self.log("Started reading.")
@@ -297,15 +496,17 @@ class MainWindow(ttk.Frame):
         """Send a task to the controller that toggles whether the data is recorded or not."""
         if self.reading:
             if self.recording:
-                self.queue.put(('ctrl', {'task': 'stop_record'}))
+                self.queue.put(StopRecord())
                 self.btn_record["text"] = "Record Start"
                 self.recording = False
                 self.log("Stopped recording.")
             else:
-                self.queue.put(('ctrl', {'task': 'start_record'}))
+                triggered = self.triggered.get()
+                self.config.set('trigger_record', int(triggered))
+                self.queue.put(StartRecord(triggered))
                 self.btn_record["text"] = "Record Stop"
                 self.recording = True
-                self.log("Started recording.")
+                self.log("Started triggered recording." if triggered else "Started recording.")
             self.queue_event.set()
 
         else:
@@ -313,13 +514,18 @@ class MainWindow(ttk.Frame):
 
     def task_query_instruments(self):
         """Send a task to the controller that queries all VISA instruments."""
-        self.queue.put(('ctrl', {'task': 'query_instruments'}))
+        self.queue.put(QueryInstruments())
         self.queue_event.set()
 
     def task_update_charts(self):
-        """Send a task to the controller that updates the graph."""
-        self.queue.put(('disp', {'task': 'update_chart'}))
-        self.queue_event.set()
+        """Apply pending pipeline records and update the graph, on the main thread."""
+        if self.plot_trace.busy or self.plot_mark.busy:
+            # still rendering the last frame: skip this one, records wait in `pending`
+            self.plot_trace.skipped += self.plot_trace.busy
+            self.plot_mark.skipped += self.plot_mark.busy
+        else:
+            self.process_pending()
+            self.update_chart()
         self.after(1000, self.task_update_charts)
 
     ##################
@@ -327,19 +533,57 @@ class MainWindow(ttk.Frame):
     ##################
 
     def log(self, value=None):
-        """Log to the output text field."""
-        time = dt.datetime.now().isoformat(sep=" ", timespec="seconds")
-        self.output.configure(state='normal')
-        self.output.insert(tk.END, f"{time} : {value}\n")
-        self.output.configure(state='disabled')
-
-    def set_trigger(self, queue=None, queue_event=None, quit_event=None):
+        """Log to the output text field and any other log sinks."""
+        event = LogEvent(dt.datetime.now(), value)
+        if self.pipeline:
+            self.pipeline.publish(event)
+        else:
+            self.logbuffer.add(event.time.isoformat(sep=" ", timespec="seconds"), value)
+
+    def task_update_log(self):
+        """Insert buffered log lines into the output in one go, on the main thread."""
+        lines = self.logbuffer.drain()
+        if lines:
+            self.output.configure(state='normal')
+            self.output.insert(tk.END, "\n".join(lines) + "\n")
+            excess = int(self.output.index('end-1c').split('.')[0]) - LOG_LINES
+            if excess > 0:
+                self.output.delete('1.0', f'{excess + 1}.0')
+            self.output.configure(state='disabled')
+            self.output.see(tk.END)
+        self.after(LOG_REFRESH, self.task_update_log)
+
+    def set_trigger(self, queue=None, queue_event=None, quit_event=None, pipeline: Pipeline = None):
         """Start-up actions."""
         self.queue = queue
         self.queue_event = queue_event
         self.quit_event = quit_event
+        self.pipeline = pipeline
+        self.pipeline.subscribe(DisplaySink(self))
+        self.pipeline.subscribe(ConsoleSink(self.logbuffer))
+        self.pipeline.subscribe(self.stats)
         self.task_query_instruments()
         self.task_update_charts()
+        self.task_update_log()
+
+    def process_pending(self):
+        """Dispatch records received from the pipeline."""
+        while self.pending:
+            rec = self.pending.popleft()
+            if isinstance(rec, MarkerBatch):
+                self.add_marks(rec)
+            elif isinstance(rec, Gap):
+                self.plot_mark.add_gap(rec.time)
+            elif isinstance(rec, ResourceList):
+                self.set_instruments(rec.resources)
+            elif isinstance(rec, CommandLatency):
+                self.add_latency(rec)
+            elif isinstance(rec, TuneResult):
+                self.set_profile(rec)
+        updated = self.traces.updated()
+        if updated:
+            x, self.trace_y = self.traces.read(min(updated), self.trace_y)  # lowest harmonic
+            self.set_trace(x, self.trace_y)
 
     def set_instruments(self, instruments):
         """Save instrument"""
@@ -355,14 +599,38 @@ class MainWindow(ttk.Frame):
                 label=choice, command=tk._setit(self.instrument, choice)
             )
 
+    def set_profile(self, rec: TuneResult):
+        """Save a tuned sweep profile and show its range if it was applied."""
+        if rec.profile is None:
+            return
+        self.config.set(f'profile_{rec.name}', format_profile(rec.profile))
+        self.log(f"Sweep profile '{rec.name}' saved.")
+        if rec.applied:
+            self.config.set('profile', rec.name)
+            self.config.set('start', rec.start)
+            self.config.set('stop', rec.stop)
+            for entry, value in ((self.ipt_start, rec.start), (self.ipt_stop, rec.stop)):
+                entry.delete(0, tk.END)
+                entry.insert(0, f"{value:.0f}")
+            self.plot_mark.set_ylim(rec.start, rec.stop)
+        self.config.save()
+
+    def add_latency(self, rec: CommandLatency):
+        """Update the latency statistics of a command."""
+        latency = rec.wait + rec.run
+        stats = self.latency.setdefault(rec.command, [0, 0, 0, 0])
+        stats[0] += 1
+        stats[1] = latency
+        stats[2] += latency
+        stats[3] = max(stats[3], latency)
+
     def set_trace(self, x: Iterable = None, y: Iterable = None):
         """Save incoming full trace."""
         self.plot_trace.set_data(x, y)
 
-    def add_mark(self, value=None):
-        """Save incoming resonance frequency point."""
-        x, y = value
-        self.plot_mark.append_data(x, y)
+    def add_marks(self, batch: MarkerBatch):
+        """Save incoming resonance frequency points."""
+        self.plot_mark.append_many(batch.times, batch.freqs, batch.channel)
 
     def update_chart(self):
         """Update all charts."""
@@ -370,6 +638,51 @@ class MainWindow(ttk.Frame):
         self.plot_mark.update_plot()
 
 
+class StatsPanel(tk.Toplevel):
+    """Window showing running statistics and Allan deviation of each channel."""
+    def __init__(self, parent, stats: StatsSink):
+        super().__init__(parent)
+        self.title("Noise statistics")
+        self.geometry('500x400')
+        self.stats = stats
+
+        self.summary = tk.Label(self, justify=tk.LEFT, anchor='w')
+        self.summary.grid(row=0, column=0, sticky=NWE, padx=PADX, pady=PADY)
+
+        columns = ("channel", "tau", "adev", "fractional", "count")
+        self.table = ttk.Treeview(self, columns=columns, show='headings')
+        for col, heading in zip(columns, ("n", "τ [s]", "σ [Hz]", "σ/f", "pairs")):
+            self.table.heading(col, text=heading)
+            self.table.column(col, width=80, anchor='e')
+        self.table.grid(row=1, column=0, sticky=tk.NSEW, padx=PADX, pady=PADY)
+
+        self.btn_reset = ttk.Button(self, text="Reset", command=self.stats.reset)
+        self.btn_reset.grid(row=2, column=0, sticky=tk.E, padx=PADX, pady=PADY)
+
+        self.rowconfigure(1, weight=1)
+        self.columnconfigure(0, weight=1)
+        self.refresh()
+
+    def refresh(self):
+        """Show the current statistics."""
+        lines = []
+        self.table.delete(*self.table.get_children())
+        for channel, summary in self.stats.summary().items():
+            lines.append(
+                f"n={channel}: {summary['count']} points, mean {summary['mean']:.2f} Hz, "
+                f"std {summary['std']:.3f} Hz, drift {summary['drift']:.3f} Hz/h"
+            )
+            for tau, adev, count in summary['adev']:
+                self.table.insert(
+                    '',
+                    tk.END,
+                    values=(channel, f"{tau:.4g}", f"{adev:.4g}", f"{adev / summary['mean']:.3e}",
+                            count),
+                )
+        self.summary["text"] = "\n".join(lines) or "No data yet."
+        self.after(STATS_REFRESH, self.refresh)
+
+
 ##################
 #### Run detached
 ##################
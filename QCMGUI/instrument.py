@@ -3,13 +3,23 @@ Class that abstracts interaction with the VISA instrument.
 """
 
 import datetime as dt
-import pathlib
 import threading
 import time
 
 import numpy as np
 import pyvisa
-from pyvisa.util import from_ascii_block
+
+from averaging import TraceAverager
+from pipeline import LogEvent, Marker, Pipeline, RecordMode, ResourceList, Trace, TuneResult
+from scheduler import HarmonicScheduler
+from scpi import ScpiState
+from simulation import FakeSession
+from tracking import ZoomTracker
+from tuning import SweepTuner, candidates
+from watchdog import ConnectionSupervisor
+
+# errors which indicate a failed session
+VISA_ERRORS = (pyvisa.errors.VisaIOError, pyvisa.errors.InvalidSession)
 
 
 class VISAInstrument():
@@ -17,102 +27,372 @@ class VISAInstrument():
     Abstract instrument class that communicates with the VISA instrument.
     Needs subclassing for each instrument class.
     """
-    def __init__(self, dfolder: pathlib.Path):
-        # references to command queue
+    tunable = ()  # sweep parameters of `profile` the instrument can set
+
+    def __init__(self):
+        # references to command queue and data pipeline
         self.queue = None
         self.queue_event = None
         self.quit_event = None
-
-        # file paths and pointers
-        if not dfolder.exists():
-            dfolder.mkdir()
-        self.fp_marker = open(dfolder / "markers.csv", 'a', encoding="utf8")
-        self.f_traces = dfolder / "traces"
-        if not self.f_traces.exists():
-            self.f_traces.mkdir()
+        self.pipeline = None
 
         # VISA init
         self.rm = None
         self.instrument = None
-        self.rm = pyvisa.ResourceManager()
+        try:
+            self.rm = pyvisa.ResourceManager()
+        except ValueError as e:
+            print(f"No VISA implementation available: {e}")
+        self.resource = None  # resource string of the connected instrument
+        self.state = ScpiState()  # last applied instrument settings
+        self.last_config = None  # arguments of the last `configure`
+        self.profile = {}  # sweep parameters (rbw, vbw, points) overriding defaults
+        self.sweep_timeout = 3000  # ms, session timeout once configured
+        self.lock = threading.RLock()  # serialises access to the session
+
+        # watch the session and reconnect on failure
+        self.supervisor = ConnectionSupervisor(self)
+        self.supervisor.start()
 
         # setup measurement thread
-        self.reftime = None
-        self.thread_measure = threading.Thread(target=self.measure, daemon=True)
+        self.thread_measure = threading.Thread(target=self.measure, name="Measure", daemon=True)
         self.thread_measure_flag = False
         self.thread_record_flag = False
+        self.interval = 0.5  # s between acquisitions
+        self.frange = None  # frequencies of the trace points
+        self.scheduler = None  # windows to acquire, set on configuration
+        self.clock = dt.datetime.now  # timestamps measurements, replaceable for tests
         self.thread_measure.start()
 
     def query_instruments(self):
         """Get all available instruments."""
-        if not self.rm:
-            return
         try:
+            if not self.rm:
+                raise ValueError
             instruments = self.rm.list_resources("?*")
             instruments = instruments + ("Simulation", )
-            self.queue.put(('disp', {
-                'task': 'set_instruments',
-                'instruments': instruments,
-            }))
         except ValueError:
             self.log("Could not find a VISA resource. Switching to simulated connection.")
-            self.queue.put(('disp', {
-                'task': 'set_instruments',
-                'instruments': ("Simulation", ),
-            }))
+            instruments = ("Simulation", )
+        self.publish(ResourceList(dt.datetime.now(), instruments))
 
     def connect(self, instrument='TCPIP::127.0.0.1::HISLIP'):
         """Connect to a specified instrument string."""
-        if not self.rm:
+        self.supervisor.online.clear()
+        self.last_config = None
+        try:
+            with self.lock:
+                self.open_session(instrument)
+                idn = self.instrument.query('*IDN?')
+        except Exception as e:
+            self.log(f'Unexpected connection error {repr(e)}.')
             return
 
+        self.resource = instrument
+        self.supervisor.online.set()
+        self.log(f"Connected to {idn}")
+
+    def open_session(self, instrument):
+        """Open a VISA session, replacing any existing one."""
+        self.close_session()
+        self.state.invalidate()
         if instrument == 'Simulation':
+            self.instrument = FakeSession()
+        elif not self.rm:
+            raise ValueError("No VISA implementation available.")
+        else:
             self.instrument = self.rm.open_resource(
-                'TCPIP::127.0.0.1::HISLIP',
-                id_query=True,
-                reset=True,
-                option_string="Simulate=True",
+                instrument,
+                read_termination='\n',
             )
-        else:
+        self.instrument.timeout = self.sweep_timeout
+
+    def close_session(self):
+        """Close the VISA session, ignoring errors from a dead one."""
+        if self.instrument:
             try:
-                self.instrument = self.rm.open_resource(
-                    instrument,
-                    read_termination='\n',
-                )
-            except Exception as e:
-                self.log(f'Unexpected connection error {repr(e)}.')
-                self.log(e.args[0])
+                self.instrument.close()
+            except Exception:
+                pass
+        self.instrument = None
+
+    def reopen(self):
+        """Re-open the session to the last connected instrument."""
+        with self.lock:
+            self.open_session(self.resource)
+            self.instrument.query('*IDN?')
+
+    def restore(self):
+        """Re-apply the last configuration, if any."""
+        if self.last_config:
+            self.configure(**self.last_config)
+
+    ##################
+    #### Configuration
+    ##################
+
+    def configure(
+        self,
+        start=9.92e6,
+        stop=10.02e6,
+        harmonics=(1, ),
+        zoom=0,
+        average=1,
+        average_mode="running",
+        decimate=1,
+        profile=None,
+    ):
+        """
+        Configure the connected instrument.
+        Only settings changed since the last configuration are sent, unless
+        the instrument is new to us, in which case it is reset first.
+        If several harmonics are requested, acquisition cycles through a
+        window around each of them.
+        If `zoom` is given, each window narrows to `zoom` times the resonance
+        width and follows the peak.
+        Sweeps of each window are averaged over `average` sweeps and
+        decimated by `decimate` points before being published.
+        A sweep `profile` replaces the default bandwidths and point count.
+        """
+        if not self.instrument:
+            self.log('Not connected to any instrument.')
+            return
 
-        self.instrument.timeout = 3000
-        self.log(f"Connected to {self.instrument.query('*IDN?')}")
+        self.last_config = {
+            'start': start,
+            'stop': stop,
+            'harmonics': harmonics,
+            'zoom': zoom,
+            'average': average,
+            'average_mode': average_mode,
+            'decimate': decimate,
+            'profile': profile,
+        }
+        self.profile = dict(profile or {})
+        with self.lock:
+            self._configure(start, stop)
+            self.scheduler = HarmonicScheduler(harmonics, start, stop, self.settings, self.frange)
+            if zoom:
+                for window in self.scheduler.windows:
+                    window.tracker = ZoomTracker(window.start, window.stop, factor=zoom)
+            if average > 1 or decimate > 1:
+                for window in self.scheduler.windows:
+                    window.averager = TraceAverager(average, average_mode, decimate=decimate)
+            if not self.scheduler.multi and self.scheduler.windows[0].n != 1:
+                # a single overtone: sweep its window rather than the fundamental range
+                self.state.apply(self.instrument, self.scheduler.windows[0].settings)
+            self.continuous(not self.scheduler.multi)
+            if self.scheduler.multi:
+                self.log(f"Tracking harmonics {', '.join(map(str, harmonics))}.")
+
+    def _configure(self, start, stop):
+        """Apply the configuration, with the session locked."""
+        fresh = not self.state.check(self.instrument)
+        if fresh:
+            self.instrument.timeout = 30000
+            self.reset()
+
+        try:
+            changes = self.state.apply(self.instrument, self.settings(start, stop))
+            if fresh:
+                self.reference_sweep()
+        finally:
+            self.instrument.timeout = self.sweep_timeout
+
+        if not changes:
+            self.log("Configuration unchanged.")
+            return
+
+        self.configured(start, stop)
+
+        # done
+        self.log(f"Configuration complete, {len(changes)} settings changed.")
+
+    def settings(self, start, stop) -> dict:
+        """Target instrument state for a frequency range, as SCPI headers and values."""
+        return {}
+
+    def reset(self):
+        """Bring the instrument to a known state. Should be implemented in subclasses."""
+
+    def reference_sweep(self):
+        """Actions after a full configuration. Should be implemented in subclasses."""
+
+    def configured(self, start, stop):
+        """Update cached sweep information after a configuration change."""
+
+    def continuous(self, on: bool):
+        """Switch between continuous and triggered sweeps."""
+
+    def trigger(self):
+        """Take a single sweep and wait for it, when not sweeping continuously."""
+
+    def tune(self, target, name="tuned", apply_best=False):
+        """
+        Benchmark sweep settings around the resonance and publish the fastest
+        one with a peak frequency noise below `target` Hz. The previous
+        configuration is restored unless `apply_best` is set.
+        """
+        if not self.last_config:
+            self.log('Configure the instrument before tuning.')
+            return
+        config = dict(self.last_config)
+        span = config['stop'] - config['start']
+        tuner = SweepTuner(self, target)
+        self.log(f"Tuning sweep settings for {target} Hz resolution.")
+        self.profile = dict(config['profile'] or {})
+        # keep the session until the configuration is restored or applied, so the
+        # measurement thread never sweeps with a candidate's settings
+        with self.lock:
+            timeout = self.instrument.timeout
+            self.instrument.timeout = 60000
+            try:
+                results = tuner.run(config['start'], config['stop'], candidates(self.tunable, span))
+            except Exception:
+                try:
+                    self.instrument.timeout = timeout
+                    self.configure(**config)  # back to the settings before tuning
+                except Exception as err:
+                    self.log(f"Could not restore the configuration after tuning: {repr(err)}")
+                raise
+            self.instrument.timeout = timeout
+            best = tuner.best(results)
+
+            if best is None:
+                self.log(f"No setting reached {target} Hz, keeping the current one.")
+                self.configure(**config)
+                self.publish(TuneResult(dt.datetime.now(), name, None))
+                return
+
+            profile = best.candidate.profile()
+            start = tuner.centre - best.candidate.span / 2
+            stop = tuner.centre + best.candidate.span / 2
+            self.log(
+                f"Fastest setting within {target} Hz: {profile}, "
+                f"span {best.candidate.span:.0f} Hz, "
+                f"{best.sweep_time * 1000:.0f} ms per sweep, {best.noise:.2f} Hz noise."
+            )
+            if apply_best:
+                config.update(start=start, stop=stop, profile=profile)
+            self.configure(**config)
+        self.publish(TuneResult(dt.datetime.now(), name, profile, start, stop, apply_best))
+
+    ##################
+    #### Measurement
+    ##################
 
     def measure(self):
-        """Perform measurement. Should be implemented in subclasses."""
+        """
+        Perform measurements on the connected instrument.
+        This function is designed to be called from a thread.
+        """
+        while True:
+            # Exit if needed
+            if self.quit_event and self.quit_event.is_set():
+                print("Exiting VA measurement thread.")
+                break
+
+            if not (self.thread_measure_flag and self.supervisor.online.is_set()):
+                time.sleep(0.5)
+                continue
+
+            mark = None
+            trace = None
+            window = None
+            scheduler = None
+            frange = self.frange
+            try:
+                with self.lock:
+                    scheduler = self.scheduler  # configure may replace it meanwhile
+                    if scheduler:
+                        window = scheduler.next()
+                        frange = window.frange
+                        if scheduler.multi:
+                            self.state.apply(self.instrument, window.settings)
+                            self.trigger()
+                    mark, trace = self.acquire()
+                    if window and window.tracker and trace is not None:
+                        self.track(window, frange, trace)
+                if window and window.averager and trace is not None:
+                    frange, trace = window.averager.add(frange, trace) or (frange, None)
+            except VISA_ERRORS as e:
+                self.supervisor.report(e)
+
+            if frange is None:
+                # not configured yet, the sweep cannot be placed in frequency
+                time.sleep(self.interval)
+                continue
+
+            timenow = self.clock()
+            channel = window.n if window else 1
+            if mark:
+                self.publish(Marker(timenow, mark, record=self.thread_record_flag, channel=channel))
+            if trace is not None:
+                self.publish(
+                    Trace(timenow, frange, trace, record=self.thread_record_flag, channel=channel)
+                )
+            if window and mark:
+                scheduler.done(window)
+                report = scheduler.report() if scheduler.multi else None
+                if report:
+                    self.log(report)
+
+            # Wait for required time
+            time.sleep(self.interval)
+
+    def track(self, window, frange, trace):
+        """Let the zoom tracker move a window, with the session locked."""
+        lost = window.tracker.lost
+        span = window.tracker.update(frange, trace)
+        if window.tracker.lost and not lost:
+            self.log(f"Resonance lost on harmonic {window.n}, widening span.")
+        if span:
+            window.set_range(*span, self.settings(*span))
+            if not self.scheduler.multi:
+                self.state.apply(self.instrument, window.settings)
+
+    def acquire(self):
+        """
+        Read the marker frequency and trace, with the session locked.
+        Should be implemented in subclasses.
+        """
+        return None, None
 
     ##################
     #### Control receive
     ##################
 
+    def publish(self, record):
+        """Send a record down the data pipeline."""
+        if self.pipeline:
+            self.pipeline.publish(record)
+
     def log(self, msg):
-        """Send log message to queue."""
-        self.queue.put(('disp', {'task': 'log', 'value': msg}))
-        self.queue_event.set()
+        """Send log message to the pipeline."""
+        self.publish(LogEvent(dt.datetime.now(), msg))
 
-    def set_trigger(self, queue=None, queue_event=None, quit_event=None):
+    def set_trigger(self, queue=None, queue_event=None, quit_event=None, pipeline: Pipeline = None):
         """Start-up actions."""
         self.queue = queue
         self.queue_event = queue_event
         self.quit_event = quit_event
+        self.pipeline = pipeline
+
+    def execute(self, cmd):
+        """Run a control command."""
+        cmd.apply(self)
 
     def run_cmd(self, cmd):
         """Run an incoming random VISA command."""
-        if cmd.endswith("?"):
-            self.log("Querying Instrument...")
-            resp = self.instrument.query(cmd)
-            self.log("Response received.")
-            self.log(resp)
-            return
-        self.instrument.write(cmd)
+        with self.lock:
+            if cmd.endswith("?"):
+                self.log("Querying Instrument...")
+                resp = self.instrument.query(cmd)
+                self.log("Response received.")
+                self.log(resp)
+                return
+            self.state.invalidate()  # we can't know what the command changed
+            self.instrument.write(cmd)
 
     def start_measure(self):
         """Start the measurement by setting the flag."""
@@ -122,165 +402,108 @@ class VISAInstrument():
         """Stop the measurement by setting the flag."""
         self.thread_measure_flag = False
 
-    def start_record(self):
-        """Start recording by setting the flag."""
-        self.reftime = dt.datetime.now()
+    def start_record(self, triggered=False):
+        """
+        Start recording by setting the flag.
+        If `triggered`, sweeps are only saved at full rate around events.
+        """
         self.thread_record_flag = True
+        self.publish(RecordMode(dt.datetime.now(), True, triggered))
 
     def stop_record(self):
         """Stop recording by setting the flag."""
         self.thread_record_flag = False
+        self.publish(RecordMode(dt.datetime.now(), False))
 
     def close(self):
         """Ask the class to close."""
         print("Vector analyser asked to close.")
         self.quit_event.set()
         self.thread_measure.join()
-        if self.instrument:
-            self.instrument.close()
-        self.fp_marker.close()
+        with self.lock:
+            self.close_session()
         print("Vector analyser closed.")
 
 
 class DSA815(VISAInstrument):
     """Specific implementation for the Rigol DSA815."""
-    def __init__(self, dfolder: pathlib.Path):
-        super().__init__(dfolder=dfolder)
-        self.frange = None
-
-    def configure(self, start=9.92e6, stop=10.02e6):
-        """Configure the connected instrument."""
-        if not self.instrument:
-            self.log('Not connected to any instrument.')
-
-        # reset everything
-        self.instrument.timeout = 30000
+    tunable = ("rbw", "vbw")  # always 601 points
+
+    def __init__(self):
+        super().__init__()
+        self.points = None
+
+    def settings(self, start, stop):
+        """Target instrument state for a frequency range, as SCPI headers and values."""
+        return {
+            # tracking generator
+            "OUTP:STAT": "ON",
+            # freq range
+            "SENS:FREQ:START": start,
+            "SENS:FREQ:STOP": stop,
+            # sweep settings
+            "SENS:BAND:RES": self.profile.get("rbw", "1KHZ"),  # RBW 1 kHz
+            "SENS:BAND:VID": self.profile.get("vbw", "1MHZ"),  # VBW 1 MHz
+            "SENS:DET:FUNC": "RMS",  # DET type RMS avg
+            "SENS:SWE:TIME:AUTO:RULES": "ACCURACY",
+            "SENS:SWE:TIME:AUTO": "ON",
+            # markers
+            "CALC:MARK1:STAT": "ON",
+            "CALC:MARK1:CPEak:STATe": "ON",
+            # freq counter
+            "CALC:MARK:FCOunt:STATe": "ON",
+            "CALC:MARK:FCOunt:RESolution": "1HZ",
+        }
+
+    def configured(self, start, stop):
+        """Query step length and compute trace frequencies."""
+        if self.points is None:
+            self.points = int(self.instrument.query(":SENSe:SWEep:POINts?"))
+        self.frange = np.linspace(start, stop, self.points)
+
+    def continuous(self, on: bool):
+        """Switch between continuous and triggered sweeps."""
+        self.instrument.write(f"INIT:CONT {'ON' if on else 'OFF'}")
+
+    def trigger(self):
+        """Take a single sweep and wait for it."""
+        self.instrument.query("INIT:IMM;*OPC?")
+
+    def reset(self):
+        """Reset the instrument and stop continuous measurement."""
         self.instrument.write("*RST")
+        self.instrument.query("*OPC?")
+        self.points = None
 
         # turn off measurement
         self.instrument.write("INIT:CONT OFF")
 
-        # tracking generator
-        self.instrument.write("OUTP:STAT ON")
-
-        # freq range
-        self.instrument.write(f"SENS:FREQ:START {start}")
-        self.instrument.write(f"SENS:FREQ:STOP {stop}")
-
-        # sweep settings
-        self.instrument.write("SENS:BAND:RES 1KHZ")  # RBW 1 kHz
-        self.instrument.write("SENS:BAND:VID 1MHZ")  # VBW 1 MHz
-        self.instrument.write("SENS:DET:FUNC RMS")  # DET type RMS avg
-        self.instrument.write("SENS:SWE:TIME:AUTO:RULES ACCURACY")
-        self.instrument.write("SENS:SWE:TIME:AUTO ON")
-
-        # scaling
-        self.instrument.write("INIT:IMM; *WAI")  # measurement for reference
-        self.instrument.write("DISP:WIN:TRAC:Y:SCALe:SPACing LIN")
-        self.instrument.write("SENS:POWer:ASCale")
-
-        # markers
-        self.instrument.write("CALC:MARK1:STAT ON")
-        self.instrument.write("CALC:MARK1:CPEak:STATe ON")
-
-        # freq counter
-        self.instrument.write('CALC:MARK:FCOunt:STATe ON')
-        self.instrument.write('CALC:MARK:FCOunt:RESolution 1HZ')
-
-        # query step length
-        steps = int(self.instrument.query(":SENSe:SWEep:POINts?"))
-
-        self.frange = np.linspace(start, stop, steps)
+    def reference_sweep(self):
+        """Take a single sweep to scale the display, then measure continuously."""
+        self.instrument.write("INIT:IMM; *WAI")
+        self.instrument.write("DISP:WIN:TRAC:Y:SCALe:SPACing LIN;:SENS:POWer:ASCale")
+        self.instrument.query("*OPC?")
 
         # turn on continuous measurement
         self.instrument.write("INIT:CONT ON")
 
-        # done
-        self.log("Configuration complete.")
-
-    def measure(self):
-        """
-        Perform measurements on the connected instrument.
-        This function is designed to be called from a thread.
-        """
-        while True:
-            # Exit if needed
-            if self.quit_event and self.quit_event.is_set():
-                print("Exiting VA measurement thread.")
-                break
-
-            if self.thread_measure_flag:
-
-                # Read marker
-                mark = None
-                try:
-                    mark = self.instrument.query("CALC:MARK1:X?")
+    def acquire(self):
+        """Read marker and trace."""
+        mark = float(self.instrument.query("CALC:MARK1:X?"))
         # mark = self.instrument.query('CALC:MARK:FCOunt:X?')
-                except pyvisa.errors.VisaIOError as e:
-                    self.log(f"Could not read marker. Error: {e}")
-                if mark:
-                    mark = float(mark)
-                    timenow = dt.datetime.now()
-                    self.queue.put((
-                        'disp',
-                        {
-                            'task': 'add_mark',
-                            'value': (timenow, mark)
-                        },
-                    ))
-
-                # Read trace
-                # With Rigol the instrument returns a header
-                # which denotes the data length.
-                # We remove this before passing it to pyVISA routines
-                data = None
-                try:
-                    self.instrument.write('TRAC:DATA? TRACE1')
-                    data = self.instrument.read()
-                except pyvisa.errors.VisaIOError as e:
-                    self.log(f"Could not read marker. Error: {e}")
-                if data:
-                    data = data[12:]
-                    trace = from_ascii_block(data)
-                    self.queue.put((
-                        'disp',
-                        {
-                            'task': 'set_trace',
-                            'x': self.frange,
-                            'y': trace,
-                        },
-                    ))
-
-                # inform read
-                self.queue_event.set()
-
-                # save if recording
-                if self.thread_record_flag:
-
-                    # Save marker
-                    if mark:
-                        self.fp_marker.write(f"{timenow},{mark}\n")
-
-                    # Save trace every X seconds
-                    if trace:
-                        if (timenow - self.reftime).seconds > 60:
-                            self.reftime = timenow
-                            filename = str(timenow).replace(':', '') + ".csv"
-                            with open(self.f_traces / filename, 'w', encoding="utf8") as f:
-                                f.writelines(
-                                    map(
-                                        lambda x: f"{x[0]},{x[1]}\n",
-                                        zip(self.frange, trace),
-                                    )
-                                )
 
-            # Wait for required time
-            time.sleep(0.5)
+        # With Rigol the instrument returns a header
+        # which denotes the data length.
+        # We remove this before passing it to pyVISA routines
+        self.instrument.write('TRAC:DATA? TRACE1')
+        data = self.instrument.read()
+        trace = np.fromstring(data[12:], sep=",") if data else None
+        return mark, trace
 
 
 if __name__ == '__main__':
 
     print("Direct control.")
-    va = DSA815(dfolder="")
+    va = DSA815()
     va.connect()
     print(va.measure())
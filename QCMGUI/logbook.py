@@ -0,0 +1,129 @@
+"""
+Log handling: a bounded, rate-limited buffer for the GUI console and a
+rotating file sink for the permanent record.
+"""
+import collections
+import logging
+import logging.handlers
+import pathlib
+import threading
+import time
+from typing import List
+
+from pipeline import LogEvent, Sink
+
+
+class LogBuffer():
+    """
+    Thread-safe bounded buffer of formatted log lines.
+
+    Identical consecutive messages are collapsed into a repeat count,
+    reported at most every `repeat_interval` seconds, and messages above
+    `rate` per second (with bursts of up to `burst`) are dropped and
+    summarised, so an error storm cannot flood the console.
+    """
+    def __init__(self, maxlen=1000, rate=10, burst=50, repeat_interval=10):
+        self.lines = collections.deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+
+        # de-duplication
+        self.last_msg = None
+        self.repeats = 0
+        self.repeat_interval = repeat_interval
+        self.repeat_stamp = time.monotonic()
+
+        # token bucket rate limiting
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.suppressed = 0
+
+    def add(self, when, msg):
+        """Add a message, subject to de-duplication and rate limiting."""
+        msg = str(msg)
+        with self.lock:
+            if msg == self.last_msg:
+                self.repeats += 1
+                return
+            self._flush_repeats(when)
+            self.last_msg = msg
+
+            if not self._take_token():
+                self.suppressed += 1
+                return
+            self._append(when, msg)
+
+    def drain(self) -> List[str]:
+        """Return and clear all lines waiting for display."""
+        when = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            if time.monotonic() - self.repeat_stamp > self.repeat_interval:
+                self._flush_repeats(when)
+            if self.suppressed:
+                self.lines.append(f"{when} : ({self.suppressed} messages suppressed)")
+                self.suppressed = 0
+            lines = list(self.lines)
+            self.lines.clear()
+        return lines
+
+    def _append(self, when, msg):
+        self.lines.append(f"{when} : {msg}")
+
+    def _flush_repeats(self, when):
+        if self.repeats:
+            self._append(when, f"(last message repeated {self.repeats} times)")
+            self.repeats = 0
+        self.repeat_stamp = time.monotonic()
+
+    def _take_token(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class ConsoleSink(Sink):
+    """Pipeline sink feeding log events into a `LogBuffer`."""
+    types = (LogEvent, )
+    batch_size = 100
+    maxsize = 1000
+
+    def __init__(self, buffer: LogBuffer):
+        self.buffer = buffer
+
+    def consume(self, records):
+        for rec in records:
+            self.buffer.add(rec.time.isoformat(sep=" ", timespec="seconds"), rec.msg)
+
+
+class LogFile(Sink):
+    """Pipeline sink writing every log event to a size-rotated file."""
+    types = (LogEvent, )
+    batch_size = 100
+    maxsize = 0
+
+    def __init__(self, path: pathlib.Path, max_bytes=1_000_000, backups=5):
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        self.handler = logging.handlers.RotatingFileHandler(
+            path,
+            maxBytes=max_bytes,
+            backupCount=backups,
+            encoding="utf8",
+        )
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+
+    def consume(self, records):
+        for rec in records:
+            self.handler.emit(
+                logging.makeLogRecord({
+                    "msg": f"{rec.time.isoformat(sep=' ', timespec='seconds')} : {rec.msg}",
+                })
+            )
+
+    def close(self):
+        self.handler.close()
@@ -0,0 +1,217 @@
+"""
+Typed dataflow pipeline between acquisition sources and their consumers.
+
+Sources (the instrument) publish records to the pipeline. Processors and
+sinks (charts, file stores, publishers) subscribe to the record types they
+need and receive them in batches on their own thread, so that adding
+consumers does not add latency to the acquisition loop.
+"""
+import datetime as dt
+import queue
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+##################
+#### Records
+##################
+
+
+@dataclass
+class Record():
+    """Base class for everything travelling through the pipeline."""
+    time: dt.datetime
+
+
+@dataclass
+class Marker(Record):
+    """A resonance frequency reading."""
+    freq: float
+    record: bool = False  # whether the reading should be persisted
+    channel: int = 1  # harmonic number
+
+
+@dataclass
+class MarkerBatch(Record):
+    """Consecutive resonance frequency readings of one harmonic, from `time` on."""
+    channel: int
+    times: List[dt.datetime]
+    freqs: List[float]
+
+
+@dataclass
+class Trace(Record):
+    """A full frequency sweep."""
+    x: Any
+    y: Any
+    record: bool = False  # whether the sweep should be persisted
+    channel: int = 1  # harmonic number
+
+
+@dataclass
+class Gap(Record):
+    """A period without data, from `time` to `end`, e.g. a lost connection."""
+    end: dt.datetime
+    record: bool = False  # whether the gap happened while recording
+
+
+@dataclass
+class RecordMode(Record):
+    """Recording was switched on or off, `triggered` to save sweeps only around events."""
+    recording: bool
+    triggered: bool = False
+
+
+@dataclass
+class LogEvent(Record):
+    """A message for the operator."""
+    msg: str
+
+
+@dataclass
+class ResourceList(Record):
+    """The VISA resources available for connection."""
+    resources: Tuple[str, ...]
+
+
+@dataclass
+class TuneResult(Record):
+    """Outcome of sweep tuning: the best profile and its range, if any met the target."""
+    name: str
+    profile: Optional[Dict[str, float]]
+    start: float = 0
+    stop: float = 0
+    applied: bool = False
+
+
+@dataclass
+class CommandLatency(Record):
+    """Time a command waited in the queue and took to run, in seconds."""
+    command: str
+    wait: float
+    run: float
+
+
+##################
+#### Consumers
+##################
+
+
+class Sink():
+    """
+    Base consumer of pipeline records.
+    Subclasses select record `types` and implement `consume`.
+    """
+    types: Tuple[Type[Record], ...] = (Record, )
+    batch_size = 1  # maximum number of records per `consume` call
+    maxsize = 100  # records buffered before the oldest are dropped, 0 is unbounded
+    linger = 0  # seconds to wait for more records to fill a batch
+
+    pipeline = None  # set on subscription
+
+    def consume(self, records: List[Record]):
+        """Handle a batch of records. Runs in the subscription thread."""
+
+    def close(self):
+        """Release any resources. Runs in the subscription thread."""
+
+
+class Processor(Sink):
+    """A sink which can publish derived records back into the pipeline."""
+    def emit(self, record: Record):
+        """Publish a derived record."""
+        if self.pipeline:
+            self.pipeline.publish(record)
+
+
+_STOP = object()
+
+
+class Subscription(threading.Thread):
+    """Buffer and thread which feed a single sink."""
+    def __init__(self, sink: Sink):
+        super().__init__(daemon=True)
+        self.name = f"Sink-{type(sink).__name__}"
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=sink.maxsize)
+        self.dropped = 0
+
+    def offer(self, record):
+        """Enqueue without blocking, dropping the oldest record if full."""
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def stop(self):
+        """Ask the thread to finish once the buffer is drained."""
+        self.queue.put(_STOP)
+
+    def run(self):
+        """Collect batches and hand them to the sink."""
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.sink.linger
+            while len(batch) < self.sink.batch_size:
+                try:
+                    wait = deadline - time.monotonic()
+                    item = self.queue.get(timeout=wait) if wait > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    running = False
+                    break
+                batch.append(item)
+
+            try:
+                self.sink.consume(batch)
+            except Exception:
+                traceback.print_exc()
+
+        try:
+            self.sink.close()
+        except Exception:
+            traceback.print_exc()
+
+
+class Pipeline():
+    """Fan-out of published records to all matching subscriptions."""
+    def __init__(self):
+        self.subscriptions: Tuple[Subscription, ...] = ()
+        self.lock = threading.Lock()
+
+    def subscribe(self, sink: Sink) -> Subscription:
+        """Attach a sink and start its thread."""
+        sink.pipeline = self
+        sub = Subscription(sink)
+        with self.lock:
+            self.subscriptions = self.subscriptions + (sub, )
+        sub.start()
+        return sub
+
+    def publish(self, record: Record):
+        """Send a record to every interested sink. Never blocks."""
+        for sub in self.subscriptions:
+            if isinstance(record, sub.sink.types):
+                sub.offer(record)
+
+    def close(self, timeout=5):
+        """Stop all subscriptions, letting them drain their buffers."""
+        with self.lock:
+            subs, self.subscriptions = self.subscriptions, ()
+        for sub in subs:
+            sub.stop()
+        for sub in subs:
+            sub.join(timeout)
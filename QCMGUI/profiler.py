@@ -0,0 +1,136 @@
+"""
+Sampling profiler for all threads of the running program, so a misbehaving
+session can be profiled without restarting it.
+
+While running, the stack of every thread is sampled at a fixed interval.
+On stop, one folder per session is written with, for each thread:
+
+* `<thread>.folded`: collapsed stacks, one `frame;frame;frame count` line
+  per distinct stack, ready for flamegraph.pl or speedscope.
+* `<thread>.txt`: the functions taking most samples, by own and total time.
+"""
+import collections
+import datetime as dt
+import pathlib
+import re
+import sys
+import threading
+import time
+from typing import Counter, Dict, Tuple
+
+
+def frame_label(code) -> str:
+    """Readable, unique name of a code object."""
+    return f"{code.co_name} ({pathlib.Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class ThreadProfiler(threading.Thread):
+    """
+    Sample the stacks of all threads every `interval` seconds.
+    Sampling only takes the GIL briefly, so the cost on the profiled threads
+    is small and does not depend on how many calls they make.
+    """
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.name = "ThreadProfiler"
+        self.interval = interval
+        self.stacks: Dict[str, Counter[Tuple[str, ...]]] = collections.defaultdict(
+            collections.Counter
+        )
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self.stop_event = threading.Event()
+        self.labels = {}  # code object -> label cache
+
+    def run(self):
+        self.started = time.perf_counter()
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+        self.stopped = time.perf_counter()
+
+    def sample(self):
+        """Record the current stack of every other thread."""
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = self.labels.get(code)
+                if label is None:
+                    label = self.labels[code] = frame_label(code)
+                stack.append(label)
+                frame = frame.f_back
+            stack.reverse()  # root first
+            self.stacks[names.get(ident, f"Thread-{ident}")][tuple(stack)] += 1
+        self.samples += 1
+
+    def stop(self) -> float:
+        """Stop sampling, returning the profiled duration in seconds."""
+        self.stop_event.set()
+        self.join()
+        return self.stopped - self.started
+
+    def write(self, folder: pathlib.Path, top=30):
+        """Write collapsed stacks and a summary for each thread."""
+        folder.mkdir(parents=True, exist_ok=True)
+        for thread, stacks in self.stacks.items():
+            name = re.sub(r"[^\w.-]", "_", thread)
+            with open(folder / f"{name}.folded", 'w', encoding="utf8") as fp:
+                for stack, count in stacks.most_common():
+                    fp.write(f"{';'.join(stack)} {count}\n")
+            with open(folder / f"{name}.txt", 'w', encoding="utf8") as fp:
+                fp.write(self.summary(thread, top))
+
+    def summary(self, thread: str, top=30) -> str:
+        """Functions of a thread with most samples, by own and total time."""
+        stacks = self.stacks[thread]
+        total = sum(stacks.values())
+        own = collections.Counter()
+        cumulative = collections.Counter()
+        for stack, count in stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                cumulative[label] += count
+
+        lines = [f"{thread}: {total} samples every {self.interval * 1000:g} ms\n"]
+        for title, counts in (("Own time", own), ("Total time", cumulative)):
+            lines.append(f"\n{title}\n")
+            for label, count in counts.most_common(top):
+                lines.append(f"{count / total * 100:6.1f}% {count:8d}  {label}\n")
+        return "".join(lines)
+
+
+class ProfileSession():
+    """Start and stop profiling, writing results under a data folder."""
+    def __init__(self, dfolder: pathlib.Path, interval=0.005):
+        self.dfolder = dfolder
+        self.interval = interval
+        self.profiler = None
+
+    @property
+    def running(self) -> bool:
+        """Whether a profile is being taken."""
+        return self.profiler is not None
+
+    def start(self):
+        """Start sampling all threads."""
+        if self.profiler:
+            return
+        self.profiler = ThreadProfiler(self.interval)
+        self.profiler.start()
+
+    def stop(self) -> pathlib.Path:
+        """Stop sampling and write the results, returning their folder."""
+        profiler, self.profiler = self.profiler, None
+        duration = profiler.stop()
+        folder = self.dfolder / "profiles" / dt.datetime.now().strftime("%Y-%m-%d %H%M%S")
+        profiler.write(folder)
+        with open(folder / "session.txt", 'w', encoding="utf8") as fp:
+            fp.write(
+                f"{duration:.1f} s, {profiler.samples} samples, "
+                f"threads: {', '.join(sorted(profiler.stacks))}\n"
+            )
+        return folder
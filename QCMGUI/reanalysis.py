@@ -0,0 +1,102 @@
+"""
+Batch reanalysis of recorded trace files using all processor cores.
+
+Usage:
+    python QCMGUI/reanalysis.py current_data [--workers N] [--chunk 200]
+
+Every trace in `<data folder>/traces` is analysed with the same peak
+finding as live tracking, and one row per sweep is streamed to
+`<data folder>/reanalysis.csv`. Traces already present in the output are
+skipped, so an interrupted run continues where it stopped.
+"""
+import argparse
+import concurrent.futures
+import os
+import pathlib
+import sys
+import time
+import warnings
+from typing import List
+
+import numpy as np
+
+from analysis import find_peak
+from storage import parse_trace_filename
+
+COLUMNS = "file,time,channel,freq,width,height,snr\n"
+
+
+def analyse_chunk(paths: List[str]) -> List[str]:
+    """Analyse a chunk of trace files, returning one output row per file."""
+    rows = []
+    for path in paths:
+        name = os.path.basename(path)
+        try:
+            time, channel = parse_trace_filename(name)
+        except ValueError:
+            continue  # not a trace file
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)  # empty file, reported below
+                data = np.loadtxt(path, delimiter=",", ndmin=2)
+            if data.shape[0] == 0 or data.shape[1] < 2:
+                print(f"Skipping empty or truncated trace {name}.", file=sys.stderr)
+                continue
+            peak = find_peak(data[:, 0], data[:, 1])
+        except ValueError as err:
+            print(f"Skipping unreadable trace {name}: {err}", file=sys.stderr)
+            continue
+        if peak is None:
+            rows.append(f"{name},{time},{channel},nan,nan,nan,nan\n")
+        else:
+            rows.append(
+                f"{name},{time},{channel},{peak.freq},{peak.width},{peak.height},{peak.snr}\n"
+            )
+    return rows
+
+
+def done_files(output: pathlib.Path) -> set:
+    """Files already present in an existing output."""
+    if not output.exists():
+        return set()
+    with open(output, encoding="utf8") as fp:
+        next(fp, None)
+        return {line.split(",", 1)[0] for line in fp if line.strip()}
+
+
+def reanalyse(dfolder: pathlib.Path, output: pathlib.Path = None, workers=None, chunk=200):
+    """Analyse all traces in a data folder in parallel."""
+    output = output or dfolder / "reanalysis.csv"
+    done = done_files(output)
+    paths = sorted(str(p) for p in (dfolder / "traces").glob("*.csv") if p.name not in done)
+    chunks = [paths[i:i + chunk] for i in range(0, len(paths), chunk)]
+    print(f"{len(done)} traces already analysed, {len(paths)} to go.", file=sys.stderr)
+
+    new = not output.exists()
+    start = time.monotonic()
+    processed = 0
+    with open(output, 'a', encoding="utf8") as fp, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        if new:
+            fp.write(COLUMNS)
+        for paths_done, rows in zip(map(len, chunks), executor.map(analyse_chunk, chunks)):
+            fp.writelines(rows)
+            fp.flush()  # keep the output resumable
+            processed += paths_done
+            rate = processed / (time.monotonic() - start)
+            print(f"{processed}/{len(paths)} traces ({rate:.0f}/s)", file=sys.stderr)
+
+
+def main():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description="Reanalyse recorded QCM traces.")
+    parser.add_argument("folder", type=pathlib.Path, help="data folder containing 'traces'")
+    parser.add_argument("--output", type=pathlib.Path, help="output file")
+    parser.add_argument("--workers", type=int, help="worker processes, default all cores")
+    parser.add_argument("--chunk", type=int, default=200, help="traces per task")
+    args = parser.parse_args()
+    reanalyse(args.folder, args.output, args.workers, args.chunk)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+Replay of a recorded run through the live pipeline, to test processing,
+charts and storage offline with real data.
+
+Usage:
+    python QCMGUI/replay.py recorded_data [--speed 0] [--output replayed]
+
+The markers and saved traces of a data folder are published in time order,
+as if they were being acquired, either in real time, `speed` times faster,
+or as fast as possible with a speed of 0. The achieved throughput is
+logged while replaying and when the recording is exhausted.
+"""
+import argparse
+import datetime as dt
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+from typing import Iterator, Optional
+
+import numpy as np
+
+from export import read_markers_csv
+from instrument import VISAInstrument
+from pipeline import Gap, Marker, Pipeline, Record, ResourceList, Trace
+from storage import MarkerStore, TraceStore, marker_files, parse_trace_filename
+
+MARKER, GAP, TRACE = 0, 1, 2
+REPORT = 10  # s between throughput reports
+
+
+class Recording():
+    """
+    A recorded data folder, read back as a time-ordered stream of records.
+
+    Marker files are read whole when opened, so data appended to the folder
+    afterwards (for example by replaying into it) is not replayed again.
+    Traces are only listed, and loaded when their turn comes. Stands in for
+    the VISA session of a replaying instrument.
+    """
+    def __init__(self, folder: pathlib.Path, channels=None):
+        self.folder = pathlib.Path(folder)
+        self.timeout = 3000
+        files = marker_files(self.folder)
+        if not files:
+            raise FileNotFoundError(f"No recorded markers in {self.folder}.")
+
+        times, kinds, chans, values = [], [], [], []
+        self.gaps = []
+        gaps = set()
+        for channel, path in files.items():
+            if channels and channel not in channels:
+                continue
+            time_, freq = read_markers_csv(path)
+            nans = np.flatnonzero(np.isnan(freq))
+            for start, end in zip(nans[0::2], nans[1::2]):  # gaps are written as nan pairs
+                gaps.add((time_[start], time_[end]))
+            keep = ~np.isnan(freq)
+            times.append(time_[keep])
+            kinds.append(np.full(keep.sum(), MARKER, dtype=np.int8))
+            chans.append(np.full(keep.sum(), channel, dtype=np.int16))
+            values.append(freq[keep])
+
+        self.gaps = sorted(gaps)  # written to every marker file, so only kept once
+        times.append(np.array([start for start, _ in self.gaps], dtype='datetime64[us]'))
+        kinds.append(np.full(len(self.gaps), GAP, dtype=np.int8))
+        chans.append(np.zeros(len(self.gaps), dtype=np.int16))
+        values.append(np.arange(len(self.gaps), dtype=np.float64))
+
+        self.traces = []
+        for path in sorted((self.folder / "traces").glob("*.csv")):
+            try:
+                time_, channel = parse_trace_filename(path.name)
+            except ValueError:
+                continue
+            if not channels or channel in channels:
+                self.traces.append((time_, channel, path))
+        times.append(np.array([t for t, _, _ in self.traces], dtype='datetime64[us]'))
+        kinds.append(np.full(len(self.traces), TRACE, dtype=np.int8))
+        chans.append(np.array([c for _, c, _ in self.traces], dtype=np.int16))
+        values.append(np.arange(len(self.traces), dtype=np.float64))
+
+        self.times = np.concatenate(times).astype('datetime64[us]')
+        order = np.argsort(self.times, kind="stable")
+        self.times = self.times[order]
+        self.kinds = np.concatenate(kinds)[order]
+        self.channels = np.concatenate(chans)[order]
+        self.values = np.concatenate(values)[order]
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def duration(self) -> float:
+        """Recorded time span, in seconds."""
+        if not len(self.times):
+            return 0
+        return float((self.times[-1] - self.times[0]) / np.timedelta64(1, 's'))
+
+    def records(self) -> Iterator[Record]:
+        """All records in time order."""
+        for when, kind, channel, value in zip(
+                self.times.tolist(), self.kinds.tolist(), self.channels.tolist(),
+                self.values.tolist()):
+            if kind == MARKER:
+                yield Marker(when, value, channel=channel)
+            elif kind == GAP:
+                yield Gap(when, self.gaps[int(value)][1].tolist())
+            else:
+                data = np.loadtxt(self.traces[int(value)][2], delimiter=",", ndmin=2)
+                yield Trace(when, data[:, 0], data[:, 1], channel=channel)
+
+    def query(self, cmd):
+        """Answer the identification and health queries of a session."""
+        if cmd == "*OPC?":
+            return "1"
+        return f"Recording,{self.folder.name},{len(self)} records"
+
+    def write(self, cmd):
+        """A recording cannot be commanded."""
+        raise ValueError("A recording does not accept instrument commands.")
+
+    def close(self):
+        """Nothing to release, the recording is held in memory."""
+
+
+class ReplayInstrument(VISAInstrument):
+    """
+    Instrument which replays a recorded data folder instead of sweeping.
+    Connecting opens a recording, configuring rewinds it to the start for
+    the requested harmonics, and measuring publishes its records, flagged
+    for recording as live ones would be. Zoom, averaging and tuning do not
+    apply to recorded data.
+    """
+    def __init__(self, folder=None, speed=1.0):
+        self.folder = pathlib.Path(folder) if folder else None
+        self.speed = float(speed)  # times real time, 0 is as fast as possible
+        self.replay: Optional[Iterator[Record]] = None
+        self.next_record = None  # record held back while paused
+        self.origin = None  # recorded and wall time the pacing started from
+        self.channels = None  # harmonics to replay, all if None
+        self.replay_lock = threading.Lock()
+        self.generation = 0  # counts rewinds, so records taken before one are dropped
+        self.rewound = threading.Event()  # interrupts the wait for the next record
+        self.reset_counts()
+        super().__init__()
+
+    def query_instruments(self):
+        """Offer the recorded folder for connection."""
+        if not self.folder:
+            self.log("No recording to replay configured.")
+            return
+        self.publish(ResourceList(dt.datetime.now(), (str(self.folder), )))
+
+    def open_session(self, instrument):
+        """Open a recording, by default the configured folder."""
+        self.close_session()
+        self.state.invalidate()
+        self.instrument = Recording(instrument or self.folder, self.channels)
+        self.rewind()
+
+    def reopen(self):
+        """Keep the replay position, a recording held in memory cannot lose its session."""
+        with self.lock:
+            if self.instrument is None:
+                self.open_session(self.resource)
+
+    def configure(self, start=None, stop=None, harmonics=(1, ), **kwargs):
+        """Rewind the recording, keeping only the requested harmonics."""
+        if not self.instrument:
+            self.log('Not connected to any recording.')
+            return
+        self.last_config = {'start': start, 'stop': stop, 'harmonics': harmonics, **kwargs}
+        self.channels = set(harmonics)
+        with self.lock:
+            self.instrument = Recording(self.instrument.folder, self.channels)
+            self.rewind()
+        recording = self.instrument
+        self.log(
+            f"Replaying {len(recording)} records over {recording.duration / 3600:.1f} h, "
+            f"{'as fast as possible' if not self.speed else f'at {self.speed:g}x real time'}."
+        )
+
+    def tune(self, target, name="tuned", apply_best=False):
+        """Recorded sweeps cannot be tuned."""
+        self.log("Sweep settings cannot be tuned on a recording.")
+
+    def rewind(self):
+        """Restart the replay from the beginning of the recording."""
+        with self.replay_lock:
+            self.replay = self.instrument.records()
+            self.next_record = None
+            self.origin = None
+            self.reset_counts()
+            self.generation += 1
+            self.rewound.set()
+
+    ##################
+    #### Measurement
+    ##################
+
+    def measure(self):
+        """
+        Publish recorded records at the replay speed.
+        This function is designed to be called from a thread.
+        """
+        while True:
+            if self.quit_event and self.quit_event.is_set():
+                print("Exiting replay thread.")
+                break
+
+            if not (self.thread_measure_flag and self.supervisor.online.is_set() and self.replay):
+                self.origin = None  # resume pacing from wherever we stopped
+                if self.paused_at is None:
+                    self.paused_at = time.perf_counter()
+                time.sleep(0.5)
+                continue
+            if self.paused_at is not None:
+                if self.first is not None:
+                    self.paused += time.perf_counter() - self.paused_at
+                self.paused_at = None
+
+            with self.replay_lock:
+                generation = self.generation
+                self.rewound.clear()
+                rec = self.next_record or next(self.replay, None)
+                self.next_record = None
+                if rec is None:
+                    self.replay = None
+                    self.report("Replay finished")
+                    continue
+                due = self.due(rec.time)
+
+            # wait without the lock, so rewinding is not held up by pauses in the recording
+            if not self.wait(due):
+                with self.replay_lock:
+                    if generation == self.generation:
+                        self.next_record = rec
+                continue
+
+            with self.replay_lock:
+                if generation != self.generation:
+                    continue  # rewound meanwhile
+                rec.record = self.thread_record_flag
+                self.publish(rec)
+                self.count(rec)
+
+    def due(self, when: dt.datetime) -> Optional[float]:
+        """Wall time a recorded time is due at the replay speed, None if unpaced."""
+        if not self.speed:
+            return None
+        if self.origin is None:
+            self.origin = (when, time.perf_counter())
+        return self.origin[1] + (when - self.origin[0]).total_seconds() / self.speed
+
+    def wait(self, due: Optional[float]) -> bool:
+        """Sleep until a record is due, False if measurement stopped or the replay rewound."""
+        if due is None:
+            return True
+        now = time.perf_counter()
+        while now < due:
+            if not self.thread_measure_flag or (self.quit_event and self.quit_event.is_set()):
+                return False
+            if self.rewound.wait(min(due - now, 0.5)):
+                return False
+            now = time.perf_counter()
+        return True
+
+    ##################
+    #### Throughput
+    ##################
+
+    def reset_counts(self):
+        """Start counting throughput afresh."""
+        self.counts = {Marker: 0, Trace: 0, Gap: 0}
+        self.first = None  # first recorded time and wall time of the replay
+        self.last = None  # latest recorded time
+        self.reported = time.perf_counter()
+        self.paused = 0  # s spent stopped, left out of the throughput
+        self.paused_at = None
+
+    def count(self, rec: Record):
+        """Count a published record and report throughput now and then."""
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = (rec.time, now)
+        self.last = rec.time
+        self.counts[type(rec)] += 1
+        if now - self.reported > REPORT:
+            self.report("Replaying")
+
+    def throughput(self):
+        """Records published per second and the speed-up over real time."""
+        if self.first is None:
+            return 0, 0
+        elapsed = max(time.perf_counter() - self.first[1] - self.paused, 1e-9)
+        recorded = (self.last - self.first[0]).total_seconds()
+        return sum(self.counts.values()) / elapsed, recorded / elapsed
+
+    def report(self, what):
+        """Log the achieved throughput."""
+        self.reported = time.perf_counter()
+        rate, factor = self.throughput()
+        self.log(
+            f"{what}: {self.counts[Marker]} markers, {self.counts[Trace]} traces, "
+            f"{self.counts[Gap]} gaps, {rate:.0f} records/s, {factor:.0f}x real time."
+        )
+
+
+##################
+#### Offline stress test
+##################
+
+
+def main():
+    """Replay a recording into fresh marker and trace stores."""
+    parser = argparse.ArgumentParser(description="Replay a recorded QCM run into the stores.")
+    parser.add_argument("folder", type=pathlib.Path, help="recorded data folder")
+    parser.add_argument("--speed", type=float, default=0, help="times real time, 0 is unpaced")
+    parser.add_argument("--output", type=pathlib.Path, help="data folder to record into")
+    args = parser.parse_args()
+
+    output = args.output or pathlib.Path(tempfile.mkdtemp(prefix="qcm-replay-"))
+    pipeline = Pipeline()
+    pipeline.subscribe(MarkerStore(output))
+    pipeline.subscribe(TraceStore(output))
+
+    quit_event = threading.Event()
+    model = ReplayInstrument(args.folder, args.speed)
+    model.set_trigger(quit_event=quit_event, pipeline=pipeline)
+    model.connect(str(args.folder))
+    model.start_record()
+    model.start_measure()
+    while model.replay is not None:
+        time.sleep(0.5)
+    rate, factor = model.throughput()
+    print(
+        f"{sum(model.counts.values())} records, {rate:.0f} records/s, "
+        f"{factor:.0f}x real time, recorded into {output}",
+        file=sys.stderr,
+    )
+    model.close()
+    pipeline.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Acquisition scheduling across several frequency windows, used to track the
+overtones of the crystal alongside the fundamental.
+"""
+import collections
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+import numpy as np
+
+
+class Window():
+    """A frequency window around one harmonic, with its cached settings."""
+    def __init__(self, n: int, start: float, stop: float, settings: dict, frange):
+        self.n = n  # harmonic number, used as the data channel
+        self.start = start
+        self.stop = stop
+        self.settings = settings  # instrument state for this window
+        self.frange = frange  # frequencies of the trace points
+        self.tracker = None  # zoom tracker, if enabled
+        self.averager = None  # host-side averaging, if enabled
+
+    def set_range(self, start: float, stop: float, settings: dict):
+        """Move the window to a new frequency range."""
+        self.start = start
+        self.stop = stop
+        self.settings = settings
+        if self.frange is not None:
+            self.frange = np.linspace(start, stop, len(self.frange))
+
+
+class HarmonicScheduler():
+    """
+    Cycle through narrow windows around each requested harmonic.
+
+    The window around harmonic `n` is centred on `n` times the centre of the
+    fundamental range, with `n` times its span. The full instrument state of
+    each window is built once, so switching only sends the frequency range.
+    """
+    def __init__(
+        self,
+        harmonics: Iterable[int],
+        start: float,
+        stop: float,
+        settings: Callable[[float, float], dict],
+        frange,
+        report_interval=60,
+    ):
+        centre = (start + stop) / 2
+        span = stop - start
+        self.windows = []
+        for n in sorted(set(harmonics)):
+            if n == 1:
+                wstart, wstop, wrange = start, stop, frange
+            else:
+                wstart = n * (centre - span / 2)
+                wstop = n * (centre + span / 2)
+                wrange = np.linspace(wstart, wstop, len(frange)) if frange is not None else None
+            self.windows.append(Window(n, wstart, wstop, settings(wstart, wstop), wrange))
+        self.index = -1
+
+        # update rate statistics
+        self.stamps = {w.n: collections.deque(maxlen=20) for w in self.windows}
+        self.report_interval = report_interval  # s between rate reports
+        self.reported = time.monotonic()
+
+    @property
+    def multi(self) -> bool:
+        """Whether the instrument has to switch between windows."""
+        return len(self.windows) > 1
+
+    def next(self) -> Window:
+        """The window to acquire next."""
+        self.index = (self.index + 1) % len(self.windows)
+        return self.windows[self.index]
+
+    def done(self, window: Window):
+        """Mark a window as acquired."""
+        self.stamps[window.n].append(time.monotonic())
+
+    def rates(self) -> Dict[int, float]:
+        """Achieved update rate in Hz for each harmonic."""
+        rates = {}
+        for n, stamps in self.stamps.items():
+            if len(stamps) > 1 and stamps[-1] > stamps[0]:
+                rates[n] = (len(stamps) - 1) / (stamps[-1] - stamps[0])
+            else:
+                rates[n] = 0
+        return rates
+
+    def report(self) -> Optional[str]:
+        """A summary of update rates, if one is due."""
+        now = time.monotonic()
+        if now - self.reported < self.report_interval:
+            return None
+        self.reported = now
+        rates = ", ".join(f"n={n}: {r:.2f} Hz" for n, r in self.rates().items())
+        return f"Harmonic update rates: {rates}"
@@ -0,0 +1,62 @@
+"""
+Instrument settings as data: a cache of the last applied SCPI state, so
+that re-configuring only sends what changed, batched into few writes.
+"""
+import collections
+from typing import Dict, List
+
+
+def batch(settings: Dict[str, object], maxlen=256) -> List[str]:
+    """Join `header value` settings into `;:`-separated command strings."""
+    cmds = []
+    current = ""
+    for header, value in settings.items():
+        cmd = f":{header} {value}"
+        if current and len(current) + len(cmd) + 1 > maxlen:
+            cmds.append(current)
+            current = ""
+        current = f"{current};{cmd}" if current else cmd
+    if current:
+        cmds.append(current)
+    return cmds
+
+
+class ScpiState():
+    """Cache of the settings last applied to a connected instrument."""
+    def __init__(self):
+        self.identity = None
+        self.applied = collections.OrderedDict()
+
+    def invalidate(self):
+        """Forget everything, forcing a full configuration next time."""
+        self.identity = None
+        self.applied.clear()
+
+    def check(self, instrument) -> bool:
+        """Confirm the cache still describes the instrument behind the session."""
+        identity = instrument.query("*IDN?").strip()
+        if identity != self.identity:
+            self.invalidate()
+            self.identity = identity
+            return False
+        return True
+
+    def diff(self, target: Dict[str, object]) -> Dict[str, str]:
+        """Settings in `target` which differ from those last applied."""
+        return collections.OrderedDict((header, str(value))
+                                       for header, value in target.items()
+                                       if self.applied.get(header) != str(value))
+
+    def apply(self, instrument, target: Dict[str, object]) -> Dict[str, str]:
+        """Send only the changed settings and wait for completion."""
+        changes = self.diff(target)
+        try:
+            for cmd in batch(changes):
+                instrument.write(cmd)
+            if changes:
+                instrument.query("*OPC?")
+        except Exception:
+            self.invalidate()  # instrument state is now unknown
+            raise
+        self.applied.update(changes)
+        return changes
@@ -0,0 +1,314 @@
+"""
+Run acquisition in a separate process, handing data to the GUI process
+through a shared memory ring buffer.
+
+The instrument, its measurement thread and supervisor live in a child
+process, so GUI load (redraws, the GIL) cannot delay instrument polling.
+Markers, traces and gaps are copied into fixed slots of a
+`multiprocessing.shared_memory` block and an event notifies the reader.
+Commands and the occasional log message travel over multiprocessing queues,
+with stop commands on their own queue and thread as in the controller.
+"""
+import datetime as dt
+import multiprocessing as mp
+import queue
+import threading
+import time
+import traceback
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+from commands import CONTROL
+from pipeline import (
+    CommandLatency, Gap, LogEvent, Marker, Pipeline, RecordMode, ResourceList, Sink, Trace,
+    TuneResult
+)
+
+META = 8  # float64 metadata values at the start of each slot
+MARKER, TRACE, GAP = 1, 2, 3
+
+
+class SharedRing():
+    """
+    Single producer, single consumer ring of fixed size slots.
+
+    Each slot holds `[seq, kind, channel, time, freq/end, record, npoints, 0]`
+    followed by `points` x values and `points` y values. The sequence number
+    is cleared while a slot is written, so a reader can detect slots which
+    were overwritten while being copied.
+    """
+    def __init__(self, name=None, slots=64, points=5001):
+        if name is None:
+            size = 8 * (META + slots * (META + 2 * points))
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+            header = np.ndarray((META, ), dtype=np.float64, buffer=self.shm.buf)
+            header[:] = 0
+            header[1] = slots
+            header[2] = points
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+            header = np.ndarray((META, ), dtype=np.float64, buffer=self.shm.buf)
+            slots, points = int(header[1]), int(header[2])
+
+        self.header = header  # [write index, slots, points, ...]
+        self.nslots = slots
+        self.points = points
+        self.slots = np.ndarray(
+            (slots, META + 2 * points),
+            dtype=np.float64,
+            buffer=self.shm.buf,
+            offset=8 * META,
+        )
+        self.read_index = 0
+        self.dropped = 0
+
+    @property
+    def name(self):
+        """Name to attach to the ring from another process."""
+        return self.shm.name
+
+    def write(self, kind, channel, time, value, record, x=None, y=None):
+        """Write a slot. Only called by the producer."""
+        index = int(self.header[0])
+        slot = self.slots[index % self.nslots]
+        slot[0] = -1
+        npoints = 0
+        if y is not None:
+            npoints = min(len(y), self.points)
+            slot[META:META + npoints] = x[:npoints]
+            slot[META + self.points:META + self.points + npoints] = y[:npoints]
+        slot[1:META] = (kind, channel, time, value, record, npoints, 0)
+        slot[0] = index
+        self.header[0] = index + 1
+
+    def read(self) -> Optional[np.ndarray]:
+        """Copy the next unread slot, or None if there are none."""
+        while True:
+            written = int(self.header[0])
+            if self.read_index >= written:
+                return None
+            if written - self.read_index > self.nslots:  # lapped by the writer
+                self.dropped += written - self.read_index - self.nslots
+                self.read_index = written - self.nslots
+            index = self.read_index
+            self.read_index += 1
+            slot = self.slots[index % self.nslots]
+            data = slot.copy()
+            if data[0] == index and slot[0] == index:
+                return data
+            self.dropped += 1
+
+    def close(self):
+        """Release the shared memory."""
+        del self.header, self.slots
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def to_record(data: np.ndarray, points: int):
+    """Rebuild a pipeline record from a slot copy."""
+    kind, channel, time, value, record, npoints = data[1:7]
+    time = dt.datetime.fromtimestamp(time)
+    channel = int(channel)
+    record = bool(record)
+    if kind == MARKER:
+        return Marker(time, value, record=record, channel=channel)
+    if kind == GAP:
+        return Gap(time, dt.datetime.fromtimestamp(value), record=record)
+    npoints = int(npoints)
+    return Trace(
+        time,
+        data[META:META + npoints],
+        data[META + points:META + points + npoints],
+        record=record,
+        channel=channel,
+    )
+
+
+##################
+#### Acquisition process side
+##################
+
+
+class ShmPublisher(Sink):
+    """
+    Child process sink copying data records into the ring.
+    Sweeps with more points than a ring slot holds are sent whole over the
+    event queue instead, which is slower but loses nothing.
+    """
+    types = (Marker, Trace, Gap)
+    batch_size = 100
+    maxsize = 1000
+
+    def __init__(self, ring: SharedRing, ready, events):
+        self.ring = ring
+        self.ready = ready
+        self.events = events
+        self.oversize = 0  # sweeps too long for the ring
+
+    def consume(self, records):
+        for rec in records:
+            if isinstance(rec, Marker):
+                self.ring.write(MARKER, rec.channel, rec.time.timestamp(), rec.freq, rec.record)
+            elif isinstance(rec, Gap):
+                self.ring.write(GAP, 1, rec.time.timestamp(), rec.end.timestamp(), rec.record)
+            elif rec.x is None:
+                continue
+            elif len(rec.y) > self.ring.points:
+                if not self.oversize:
+                    self.events.put(LogEvent(
+                        dt.datetime.now(), f"Sweeps of {len(rec.y)} points exceed the "
+                        f"{self.ring.points} of the shared ring, sending them by queue."
+                    ))
+                self.oversize += 1
+                self.events.put(rec)
+            else:
+                self.ring.write(
+                    TRACE,
+                    rec.channel,
+                    rec.time.timestamp(),
+                    0,
+                    rec.record,
+                    np.asarray(rec.x),
+                    np.asarray(rec.y),
+                )
+        self.ready.set()
+
+
+class EventForwarder(Sink):
+    """Child process sink forwarding messages other than markers and traces."""
+    types = (LogEvent, ResourceList, RecordMode, TuneResult, CommandLatency)
+    batch_size = 100
+
+    def __init__(self, events):
+        self.events = events
+
+    def consume(self, records):
+        for rec in records:
+            if isinstance(rec, LogEvent):
+                rec = LogEvent(rec.time, str(rec.msg))  # exceptions may not pickle
+            self.events.put(rec)
+
+
+def serve(model, commands, quit_event):
+    """
+    Run commands from a queue until asked to quit, publishing their latency
+    from being issued in the GUI process to taking effect here.
+    """
+    while not quit_event.is_set():
+        try:
+            cmd = commands.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        started = time.time()
+        try:
+            model.execute(cmd)
+        except Exception as err:
+            traceback.print_exc()
+            model.log(f"Error caught -> {repr(err)} while running {cmd}")
+        finished = time.time()
+        wait = getattr(cmd, "waited", 0) + started - getattr(cmd, "sent", started)
+        model.publish(
+            CommandLatency(dt.datetime.now(), type(cmd).__name__, wait, finished - started)
+        )
+
+
+def acquisition_main(analyser, ring_name, commands, control, events, ready, quit_event):
+    """Entrypoint of the acquisition process."""
+    ring = SharedRing(ring_name)
+    pipeline = Pipeline()
+    pipeline.subscribe(ShmPublisher(ring, ready, events))
+    pipeline.subscribe(EventForwarder(events))
+
+    model = analyser()
+    model.set_trigger(quit_event=quit_event, pipeline=pipeline)
+
+    thread_control = threading.Thread(
+        target=serve, args=(model, control, quit_event), daemon=True
+    )
+    thread_control.start()
+    serve(model, commands, quit_event)
+    thread_control.join()
+
+    model.close()
+    pipeline.close()
+    ring.close()
+
+
+##################
+#### GUI process side
+##################
+
+
+class ProcessModel():
+    """
+    Stand-in for an instrument model which runs it in a child process.
+    Commands are forwarded to the child and its records published to the
+    local pipeline by a reader thread.
+    """
+    reports_latency = True  # commands take effect, and are timed, in the child
+
+    def __init__(self, analyser, slots=64, points=5001):
+        self.ring = SharedRing(slots=slots, points=points)
+        self.commands = mp.Queue()
+        self.control = mp.Queue()  # stop commands
+        self.events = mp.Queue()
+        self.ready = mp.Event()
+        self.child_quit = mp.Event()
+        self.process = mp.Process(
+            target=acquisition_main,
+            args=(analyser, self.ring.name, self.commands, self.control, self.events,
+                  self.ready, self.child_quit),
+            daemon=True,
+        )
+        self.process.start()
+
+        self.pipeline = None
+        self.quit_event = None
+        self.thread_read = threading.Thread(target=self.read, daemon=True)
+
+    def set_trigger(self, queue=None, queue_event=None, quit_event=None, pipeline: Pipeline = None):
+        """Start-up actions."""
+        self.quit_event = quit_event
+        self.pipeline = pipeline
+        self.thread_read.start()
+
+    def execute(self, cmd):
+        """Forward a command to the acquisition process, which reports its latency."""
+        cmd.waited = time.perf_counter() - getattr(cmd, "issued", time.perf_counter())
+        cmd.sent = time.time()  # wall clock, shared with the child process
+        if cmd.priority == CONTROL:
+            self.control.put(cmd)
+        else:
+            self.commands.put(cmd)
+
+    def read(self):
+        """Publish records from the acquisition process."""
+        while not self.quit_event.is_set():
+            self.ready.wait(0.5)
+            self.ready.clear()
+            while True:
+                data = self.ring.read()
+                if data is None:
+                    break
+                self.pipeline.publish(to_record(data, self.ring.points))
+            while True:
+                try:
+                    self.pipeline.publish(self.events.get_nowait())
+                except queue.Empty:
+                    break
+
+    def close(self):
+        """Stop the acquisition process and release shared memory."""
+        print("Acquisition process asked to close.")
+        self.child_quit.set()
+        self.process.join(10)
+        if self.thread_read.is_alive():
+            self.thread_read.join(2)
+        self.ring.close()
+        print("Acquisition process closed.")
@@ -0,0 +1,76 @@
+"""
+A simulated instrument session, answering the SCPI commands of a Rigol
+DSA815 with a drifting resonance. Used for the 'Simulation' connection and
+for soak testing without hardware.
+"""
+import threading
+
+import numpy as np
+
+
+class FakeSession():
+    """Minimal stand-in for a pyvisa resource talking to a DSA815."""
+    def __init__(self, f0=9.97e6, width=800, drift=0.01, noise=0.01, points=601):
+        self.timeout = 3000
+        self.f0 = f0  # resonance frequency at start
+        self.width = width  # resonance FWHM
+        self.drift = drift  # Hz per sweep
+        self.noise = noise  # relative noise amplitude
+        self.points = points
+        self.start = 9.92e6
+        self.stop = 10.02e6
+        self.sweeps = 0
+        self.pending = None
+        self.lock = threading.Lock()
+        self.rng = np.random.default_rng()
+
+    def harmonic(self):
+        """Harmonic closest to the current frequency range."""
+        return max(1, round((self.start + self.stop) / 2 / self.f0))
+
+    def resonance(self):
+        """Current resonance frequency of the harmonic in range."""
+        n = self.harmonic()
+        return n * (self.f0 + self.drift * self.sweeps) + self.rng.normal(0, 1)
+
+    def sweep(self):
+        """A new simulated trace."""
+        self.sweeps += 1
+        x = np.linspace(self.start, self.stop, self.points)
+        y = 1 / (1 + ((x - self.resonance()) / (self.harmonic() * self.width / 2))**2)
+        return y + self.rng.normal(0, self.noise, self.points)
+
+    def write(self, cmd):
+        """Accept commands, possibly `;`-joined, and remember the range."""
+        with self.lock:
+            for part in cmd.split(";"):
+                header, _, value = part.strip().lstrip(":").partition(" ")
+                if header == "SENS:FREQ:START":
+                    self.start = float(value)
+                elif header == "SENS:FREQ:STOP":
+                    self.stop = float(value)
+                elif header == "TRAC:DATA?":
+                    data = ",".join(f"{v:.6e}" for v in self.sweep())
+                    self.pending = f"#9{len(data):09d} {data}"
+
+    def read(self):
+        """Return the pending response."""
+        with self.lock:
+            resp, self.pending = self.pending, None
+            return resp
+
+    def query(self, cmd):
+        """Answer a query."""
+        cmd = cmd.strip().lstrip(":")
+        if cmd.endswith("*OPC?"):
+            return "1"
+        if cmd == "*IDN?":
+            return "Rigol Technologies,DSA815 (simulated),SIM000001,00.00.00"
+        if cmd == "SENSe:SWEep:POINts?":
+            return str(self.points)
+        if cmd.startswith("CALC:MARK1:X?"):
+            return f"{self.resonance():.1f}"
+        return "0"
+
+    def close(self):
+        """Nothing to release."""
@@ -0,0 +1,214 @@
+"""
+Soak test: drive the whole application with a fast simulated instrument
+over a long simulated run, and check that memory and latency stay flat.
+
+Usage:
+    python QCMGUI/soak.py [--hours 72] [--rate 500] [--step 0.5]
+
+Each sweep advances the measurement clock by `step` simulated seconds and
+sweeps are taken at up to `rate` per second of real time, so the defaults
+cover 72 h in about 17 minutes. RSS, live object count, queue depth and
+chart draw latency are sampled throughout. The run fails (exit code 1) if
+any of them is markedly higher in the last quarter of the run than in the
+second. Without a display, the GUI is replaced by a plain pipeline sink and
+draw latency is not measured.
+"""
+import argparse
+import datetime as dt
+import gc
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+import tkinter as tk
+
+import numpy as np
+
+from commands import Configure, Connect, StartMeasure, StartRecord
+from config import Config
+from controller import MainController
+from instrument import DSA815
+from logbook import LogFile
+from pipeline import Pipeline, Record, Sink
+from storage import MarkerStore, TraceStore
+
+COLUMNS = ("real", "simulated", "rss", "objects", "queue", "draw")
+LIMITS = {  # allowed relative growth and absolute slack from the second to the last quarter
+    "rss": (0.10, 0),
+    "objects": (0.10, 0),
+    "queue": (1.0, 100),
+    "draw": (0.50, 5),
+}
+
+
+class SimClock():
+    """Measurement clock advancing a fixed step on every reading."""
+    def __init__(self, step: float):
+        self.time = dt.datetime.now()
+        self.step = dt.timedelta(seconds=step)
+        self.lock = threading.Lock()
+
+    def now(self):
+        with self.lock:
+            self.time += self.step
+            return self.time
+
+
+class HeadlessApp():
+    """Stand-in for the main window when no display is available."""
+    def __init__(self):
+        self.pending = []
+
+    def set_trigger(self, queue=None, queue_event=None, quit_event=None, pipeline=None):
+        pipeline.subscribe(DiscardSink())
+
+    def close(self):
+        pass
+
+
+class DiscardSink(Sink):
+    """Consume display records without drawing them."""
+    types = (Record, )
+    batch_size = 1000
+    maxsize = 1000
+
+
+def rss():
+    """Resident memory of this process in bytes, if it can be measured."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", encoding="utf8") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return np.nan
+
+
+def trends(samples: np.ndarray) -> dict:
+    """Median of each metric in the second and the last quarter of a run."""
+    quarter = len(samples) // 4
+    result = {}
+    for col in LIMITS:
+        values = samples[:, COLUMNS.index(col)]
+        early, late = values[quarter:2 * quarter], values[3 * quarter:]
+        if np.isnan(early).all() or np.isnan(late).all():
+            continue
+        result[col] = (np.nanmedian(early), np.nanmedian(late))
+    return result
+
+
+def main():
+    """Run the soak test."""
+    parser = argparse.ArgumentParser(description="Soak test the QCM acquisition and display.")
+    parser.add_argument("--hours", type=float, default=72, help="simulated duration")
+    parser.add_argument("--rate", type=float, default=500, help="sweeps per real second")
+    parser.add_argument("--step", type=float, default=0.5, help="simulated seconds per sweep")
+    parser.add_argument("--sample", type=float, default=2, help="real seconds between samples")
+    parser.add_argument("--folder", type=pathlib.Path, help="data folder, default temporary")
+    args = parser.parse_args()
+
+    dfolder = args.folder or pathlib.Path(tempfile.mkdtemp(prefix="qcm-soak-"))
+    clock = SimClock(args.step)
+    end = clock.time + dt.timedelta(hours=args.hours)
+    print(f"Soak test of {args.hours} h simulated, data in {dfolder}")
+
+    pipeline = Pipeline()
+    pipeline.subscribe(MarkerStore(dfolder))
+    pipeline.subscribe(TraceStore(dfolder))
+    pipeline.subscribe(LogFile(dfolder / "logs" / "qcm.log"))
+
+    root = None
+    try:
+        from gui import MainWindow
+        root = tk.Tk()
+        root.withdraw()
+        app = MainWindow(root, Config(dfolder / "settings.cfg"), pathlib.Path(__file__).parent)
+    except tk.TclError as err:
+        print(f"No usable display ({err}), running without GUI.")
+        if root:
+            root.destroy()
+            root = None
+        app = HeadlessApp()
+
+    # time chart redraws
+    draws = []
+    if root:
+        update_chart = app.update_chart
+
+        def timed_update_chart():
+            start = time.perf_counter()
+            update_chart()
+            draws.append(time.perf_counter() - start)
+
+        app.update_chart = timed_update_chart
+
+    model = DSA815()
+    model.clock = clock.now
+    ctrl = MainController(model=model, app=app, pipeline=pipeline)
+    ctrl.start()
+
+    for cmd in (Connect("Simulation"), Configure(9.92e6, 10.02e6), StartMeasure(), StartRecord()):
+        ctrl.queue.put(cmd)
+    model.interval = 1 / args.rate
+    ctrl.queue_event.set()
+
+    samples = []
+    start = time.monotonic()
+
+    def sample():
+        depth = sum(sub.queue.qsize() for sub in pipeline.subscriptions) + len(app.pending)
+        draw = np.median(draws) * 1000 if draws else np.nan
+        draws.clear()
+        samples.append((
+            time.monotonic() - start,
+            (clock.time - end).total_seconds() / 3600 + args.hours,
+            rss(),
+            len(gc.get_objects()),
+            depth,
+            draw,
+        ))
+        print(
+            f"sim {samples[-1][1]:6.1f} h | rss {samples[-1][2] / 1e6:7.1f} MB | "
+            f"objects {samples[-1][3]:8d} | queue {depth:5d} | draw {draw:6.1f} ms",
+            flush=True,
+        )
+        return clock.time < end
+
+    if root:
+
+        def tick():
+            if sample():
+                root.after(int(args.sample * 1000), tick)
+            else:
+                root.quit()
+
+        root.after(int(args.sample * 1000), tick)
+        root.mainloop()
+    else:
+        while sample():
+            time.sleep(args.sample)
+
+    # shut down and evaluate
+    ctrl.queue_event.set()
+    ctrl.quit_event.set()
+    ctrl.join(30)
+
+    data = np.array(samples, dtype=float)
+    np.savetxt(dfolder / "soak.csv", data, delimiter=",", header=",".join(COLUMNS), comments="")
+    failed = False
+    for col, (early, late) in trends(data).items():
+        relative, slack = LIMITS[col]
+        ok = late <= early * (1 + relative) + slack
+        failed |= not ok
+        print(f"{col:8s} {early:12.1f} -> {late:12.1f} {'ok' if ok else 'FAIL'}")
+    print("Soak test", "FAILED" if failed else "passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Live noise statistics of the resonance frequency.
+
+Running mean, standard deviation and linear drift, and the Allan
+deviation at octave-spaced averaging times, are all updated incrementally
+as markers arrive, so a run of any length never needs a recompute over its
+full history.
+"""
+import math
+import threading
+from typing import Dict, List, Tuple
+
+from pipeline import Gap, Marker, Sink
+
+LEVELS = 20  # octaves of averaging time, up to 2**19 sweeps
+
+
+class RunningStats():
+    """Welford running mean, variance and least squares slope of y(t)."""
+    def __init__(self):
+        self.n = 0
+        self.mean_t = 0.0
+        self.mean_y = 0.0
+        self.m2_t = 0.0
+        self.m2_y = 0.0
+        self.c_ty = 0.0
+
+    def add(self, t: float, y: float):
+        """Add a sample at time `t` (s)."""
+        self.n += 1
+        dt = t - self.mean_t
+        dy = y - self.mean_y
+        self.mean_t += dt / self.n
+        self.mean_y += dy / self.n
+        self.m2_t += dt * (t - self.mean_t)
+        self.m2_y += dy * (y - self.mean_y)
+        self.c_ty += dt * (y - self.mean_y)
+
+    @property
+    def std(self) -> float:
+        """Sample standard deviation."""
+        return math.sqrt(self.m2_y / (self.n - 1)) if self.n > 1 else math.nan
+
+    @property
+    def slope(self) -> float:
+        """Drift in units of y per second."""
+        return self.c_ty / self.m2_t if self.m2_t > 0 else math.nan
+
+
+class AllanDeviation():
+    """
+    Non-overlapping Allan deviation at averaging times of 2**k samples.
+
+    Each level keeps the previous block average and the running sum of
+    squared differences between consecutive blocks. Pairs of blocks are
+    averaged and passed up to the next level, so a sample costs O(1)
+    amortised and O(levels) at worst.
+    """
+    def __init__(self, levels=LEVELS):
+        self.levels = levels
+        self.sums = [0.0] * levels
+        self.counts = [0] * levels
+        self.prev = [None] * levels  # last block average at each level
+        self.half = [None] * levels  # first block of a pair awaiting its partner
+        self.elapsed = 0.0  # total time between consecutive samples
+        self.intervals = 0
+
+    def add(self, y: float, dt: float = None):
+        """Add a sample, `dt` seconds after the previous one."""
+        if dt is not None:
+            self.elapsed += dt
+            self.intervals += 1
+        for k in range(self.levels):
+            if self.prev[k] is not None:
+                self.sums[k] += (y - self.prev[k])**2
+                self.counts[k] += 1
+            self.prev[k] = y
+            if self.half[k] is None:
+                self.half[k] = y
+                return
+            y = (self.half[k] + y) / 2
+            self.half[k] = None
+
+    def restart(self):
+        """Break continuity after a gap: no block may span it."""
+        self.prev = [None] * self.levels
+        self.half = [None] * self.levels
+
+    def deviations(self) -> List[Tuple[float, float, int]]:
+        """(tau, deviation, number of differences) for every populated level."""
+        tau0 = self.elapsed / self.intervals if self.intervals else math.nan
+        return [(tau0 * 2**k, math.sqrt(self.sums[k] / (2 * self.counts[k])), self.counts[k])
+                for k in range(self.levels) if self.counts[k]]
+
+
+class NoiseStats():
+    """Running statistics and Allan deviation of one channel."""
+    def __init__(self):
+        self.stats = RunningStats()
+        self.adev = AllanDeviation()
+        self.start = None
+        self.last = None
+
+    def add(self, time, freq):
+        """Add a marker."""
+        if not math.isfinite(freq):
+            self.gap()
+            return
+        if self.start is None:
+            self.start = time
+        t = (time - self.start).total_seconds()
+        dt = (time - self.last).total_seconds() if self.last else None
+        self.stats.add(t, freq)
+        self.adev.add(freq, dt)
+        self.last = time
+
+    def gap(self):
+        """Interruption in the data."""
+        self.adev.restart()
+        self.last = None
+
+    def summary(self) -> dict:
+        """Current values."""
+        return {
+            "count": self.stats.n,
+            "mean": self.stats.mean_y if self.stats.n else math.nan,
+            "std": self.stats.std,
+            "drift": self.stats.slope * 3600,  # Hz/h
+            "adev": self.adev.deviations(),
+        }
+
+
+class StatsSink(Sink):
+    """Pipeline sink keeping noise statistics for every channel."""
+    types = (Marker, Gap)
+    batch_size = 100
+    maxsize = 1000
+
+    def __init__(self):
+        self.channels: Dict[int, NoiseStats] = {}
+        self.lock = threading.Lock()
+
+    def consume(self, records):
+        with self.lock:
+            for rec in records:
+                if isinstance(rec, Gap):
+                    for stats in self.channels.values():
+                        stats.gap()
+                else:
+                    self.channels.setdefault(rec.channel, NoiseStats()).add(rec.time, rec.freq)
+
+    def summary(self) -> Dict[int, dict]:
+        """Current values of every channel."""
+        with self.lock:
+            return {channel: stats.summary() for channel, stats in sorted(self.channels.items())}
+
+    def reset(self):
+        """Forget all history."""
+        with self.lock:
+            self.channels.clear()
@@ -0,0 +1,235 @@
+"""
+Pipeline sinks which persist recorded markers and traces to disk.
+"""
+import datetime as dt
+import os
+import pathlib
+import re
+import warnings
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from pipeline import Gap, LogEvent, Marker, Processor, RecordMode, Sink, Trace
+from trigger import TraceTrigger
+
+MARKER_FILE = re.compile(r"markers(?:_n(\d+))?\.csv")
+
+
+def marker_filename(channel=1):
+    """Marker file for a harmonic, the fundamental uses `markers.csv`."""
+    return "markers.csv" if channel == 1 else f"markers_n{channel}.csv"
+
+
+def trace_filename(time, channel=1):
+    """Trace file for a sweep taken at `time` on a harmonic."""
+    suffix = "" if channel == 1 else f"_n{channel}"
+    return str(time).replace(':', '') + suffix + ".csv"
+
+
+def parse_trace_filename(name: str) -> Tuple[dt.datetime, int]:
+    """Time and channel of a trace file written by `TraceStore`."""
+    stem = name[:-4] if name.endswith(".csv") else name
+    channel = 1
+    if "_n" in stem:
+        stem, n = stem.rsplit("_n", 1)
+        channel = int(n)
+    fmt = "%Y-%m-%d %H%M%S.%f" if "." in stem else "%Y-%m-%d %H%M%S"
+    return dt.datetime.strptime(stem, fmt), channel
+
+
+def marker_files(dfolder: pathlib.Path) -> Dict[int, pathlib.Path]:
+    """Existing marker files of a data folder, by channel."""
+    files = {}
+    for path in dfolder.glob("markers*.csv"):
+        match = MARKER_FILE.fullmatch(path.name)
+        if match:
+            files[int(match.group(1) or 1)] = path
+    return files
+
+
+def _line_time(line: bytes) -> Optional[np.datetime64]:
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", UserWarning)  # a time zone, not written by us
+        try:
+            return np.datetime64(line.split(b",", 1)[0].decode(), 'us')
+        except (ValueError, UserWarning):
+            return None
+
+
+def _parse_marker_lines(lines: List[bytes]):
+    """Time and freq arrays of marker lines, dropping any which do not parse."""
+    pairs = [line.split(b",") for line in lines]
+    pairs = [pair for pair in pairs if len(pair) == 2]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", UserWarning)
+        try:
+            time, freq = np.array(pairs, dtype=bytes).reshape(-1, 2).T
+            return time.astype(str).astype('datetime64[us]'), freq.astype(float)
+        except (ValueError, UserWarning):
+            pass  # a damaged line, e.g. cut short by a crash: parse line by line
+    times, freqs = [], []
+    for time, freq in pairs:
+        stamp = _line_time(time)
+        try:
+            value = float(freq)
+        except ValueError:
+            continue
+        if stamp is not None:
+            times.append(stamp)
+            freqs.append(value)
+    return np.array(times, dtype='datetime64[us]'), np.array(freqs, dtype=float)
+
+
+def read_markers_tail(path: pathlib.Path, minutes: float, block=65536):
+    """
+    Time and freq arrays of the last `minutes` of a marker file.
+    The file is read backwards from its end in growing blocks until the
+    time span is covered, so the cost does not depend on the file size.
+    """
+    with open(path, 'rb') as fp:
+        pos = fp.seek(0, os.SEEK_END)
+        data = b""
+        last = None
+        while pos > 0:
+            step = min(block, pos)
+            pos -= step
+            fp.seek(pos)
+            data = fp.read(step) + data
+            block *= 2
+
+            lines = data.split(b"\n")
+            body = lines[1:-1] if pos > 0 else lines[:-1]  # complete lines only
+            body = [line.strip() for line in body]
+            body = [line for line in body if line]
+            if last is None:
+                last = next((t for t in map(_line_time, reversed(body)) if t is not None), None)
+                if last is None:
+                    continue
+            first = next((t for t in map(_line_time, body) if t is not None), None)
+            if first is not None and first <= last - np.timedelta64(int(minutes * 60e6), 'us'):
+                break
+
+    if last is None:
+        return np.array([], dtype='datetime64[us]'), np.array([])
+    time, freq = _parse_marker_lines(body)
+    keep = time >= last - np.timedelta64(int(minutes * 60e6), 'us')
+    return time[keep], freq[keep]
+
+
+class MarkerStore(Sink):
+    """
+    Append recorded markers to `markers.csv`, or `markers_nX.csv` for
+    overtone X. Gaps in acquisition are written as `nan` rows at their
+    start and end, in every file.
+    """
+    types = (Marker, Gap)
+    batch_size = 100
+    maxsize = 0
+
+    def __init__(self, dfolder: pathlib.Path):
+        if not dfolder.exists():
+            dfolder.mkdir()
+        self.dfolder = dfolder
+        self.fp_markers = {}
+        self.file(1)
+
+    def file(self, channel):
+        """The open marker file for a channel."""
+        fp = self.fp_markers.get(channel)
+        if fp is None:
+            fp = open(self.dfolder / marker_filename(channel), 'a', encoding="utf8")
+            self.fp_markers[channel] = fp
+        return fp
+
+    def consume(self, records):
+        """Write all markers flagged for recording."""
+        for rec in records:
+            if not rec.record:
+                continue
+            if isinstance(rec, Gap):
+                for fp in self.fp_markers.values():
+                    fp.write(f"{rec.time},nan\n{rec.end},nan\n")
+            else:
+                self.file(rec.channel).write(f"{rec.time},{rec.freq}\n")
+
+    def close(self):
+        for fp in self.fp_markers.values():
+            fp.close()
+
+
+class TraceStore(Processor):
+    """
+    Save a recorded trace to `traces/` at a fixed interval.
+    When recording is triggered, sweeps are also saved at full rate around
+    sudden frequency changes detected by the `trigger`.
+    """
+    types = (Trace, Marker, RecordMode)
+    batch_size = 10
+    maxsize = 0
+
+    def __init__(self, dfolder: pathlib.Path, interval=60, trigger: TraceTrigger = None):
+        self.f_traces = dfolder / "traces"
+        if not self.f_traces.exists():
+            self.f_traces.mkdir(parents=True)
+        self.interval = interval  # seconds between saved traces
+        self.reftime = {}  # last saved time for each channel
+        self.trigger = trigger or TraceTrigger()
+        self.triggered = False  # whether recording is triggered
+
+    def consume(self, records):
+        """Save the traces that fall on the interval or around a trigger."""
+        for rec in records:
+            if isinstance(rec, RecordMode):
+                self.set_mode(rec)
+            elif isinstance(rec, Marker):
+                if self.triggered and rec.record:
+                    self.check(rec)
+            elif not rec.record:
+                self.reftime.clear()
+            elif self.triggered and self.trigger.keep(rec):
+                self.save(rec)
+            elif not self.on_interval(rec) and self.triggered:
+                self.trigger.buffer(rec)
+
+    def set_mode(self, rec: RecordMode):
+        """Switch triggered recording on or off."""
+        self.trigger.reset()
+        self.triggered = rec.recording and rec.triggered
+        if self.triggered and not self.trigger.enabled:
+            self.triggered = False
+            self.emit(LogEvent(
+                rec.time, "Triggered recording needs trigger_step or trigger_slope in the "
+                "settings, saving traces at the interval only."
+            ))
+
+    def check(self, rec: Marker):
+        """Save the buffered sweeps if a marker triggers."""
+        reason = self.trigger.check(rec)
+        if reason:
+            buffered = self.trigger.fire()
+            for trace in buffered:
+                self.save(trace)
+            self.emit(LogEvent(
+                rec.time, f"Recording triggered by a {reason}: saved {len(buffered)} "
+                f"sweeps before, saving {self.trigger.post} after."
+            ))
+
+    def on_interval(self, rec: Trace) -> bool:
+        """Save a trace if the interval since the last one elapsed."""
+        reftime = self.reftime.get(rec.channel)
+        if reftime is None:
+            self.reftime[rec.channel] = rec.time
+        elif (rec.time - reftime).total_seconds() > self.interval:
+            self.reftime[rec.channel] = rec.time
+            self.save(rec)
+            return True
+        return False
+
+    def save(self, rec: Trace):
+        """Write a single trace as a csv file."""
+        with open(self.f_traces / trace_filename(rec.time, rec.channel), 'w', encoding="utf8") as f:
+            f.writelines(map(
+                lambda x: f"{x[0]},{x[1]}\n",
+                zip(rec.x, rec.y),
+            ))
@@ -0,0 +1,400 @@
+"""
+Live streaming of markers and traces to other processes over TCP or a
+Unix socket.
+
+Every message is a frame with an 8 byte header `<kind, channel, flags, 0,
+length>` followed by `length` bytes of payload, all little-endian:
+
+    HELLO   b"QCM1"
+    MARKER  time (f64, unix s), freq (f64)
+    GAP     start (f64), end (f64)
+    TRACE   time (f64), n (u32), x (n f64), y (n f32)
+
+`flags` bit 0 is set for data that is being recorded. Each subscriber has
+its own backlog: undelivered traces are coalesced to the latest sweep of
+each channel, and a subscriber whose marker backlog overflows is
+disconnected, so a slow reader never holds up acquisition or other
+readers.
+
+Enable with `stream = 1` in `settings.cfg`, the address being set by
+`stream_address` (`tcp://host:port` or `unix:/path/to/socket`).
+Listen with:
+    python QCMGUI/streaming.py listen [address]
+
+or benchmark the server throughput with:
+    python QCMGUI/streaming.py bench [--clients 4] [--points 601]
+"""
+import argparse
+import asyncio
+import collections
+import datetime as dt
+import socket
+import struct
+import threading
+import time
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from pipeline import Gap, Marker, Pipeline, Record, Sink, Trace
+
+HELLO, MARKER, GAP, TRACE = 0, 1, 2, 3
+MAGIC = b"QCM1"
+RECORDING = 1  # flags bit
+
+HEADER = struct.Struct("<BBBxI")
+PAIR = struct.Struct("<dd")
+TRACE_HEAD = struct.Struct("<dI")
+
+DEFAULT_ADDRESS = "tcp://127.0.0.1:5555"
+
+
+def parse_address(address: str) -> Tuple[str, object]:
+    """Split an address into ('tcp', (host, port)) or ('unix', path)."""
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    if address.startswith("tcp://"):
+        address = address[len("tcp://"):]
+    host, _, port = address.rpartition(":")
+    return "tcp", (host or "127.0.0.1", int(port))
+
+
+##################
+#### Framing
+##################
+
+
+def frame(kind, channel, flags, payload: bytes) -> bytes:
+    """A complete frame."""
+    return HEADER.pack(kind, channel, flags, len(payload)) + payload
+
+
+def streamable(rec: Record) -> bool:
+    """Whether a record can be framed: traces need matching x and y."""
+    if isinstance(rec, Trace):
+        return rec.x is not None and rec.y is not None and len(rec.x) == len(rec.y)
+    return True
+
+
+def encode(rec: Record) -> Tuple[int, int, bytes]:
+    """Frame a pipeline record, returning (kind, channel, frame)."""
+    flags = RECORDING if rec.record else 0
+    if isinstance(rec, Marker):
+        payload = PAIR.pack(rec.time.timestamp(), rec.freq)
+        return MARKER, rec.channel, frame(MARKER, rec.channel, flags, payload)
+    if isinstance(rec, Gap):
+        payload = PAIR.pack(rec.time.timestamp(), rec.end.timestamp())
+        return GAP, 1, frame(GAP, 1, flags, payload)
+    if not streamable(rec):
+        raise ValueError("Traces need x and y values of the same length.")
+    x = np.asarray(rec.x, dtype='<f8')
+    y = np.asarray(rec.y, dtype='<f4')
+    payload = TRACE_HEAD.pack(rec.time.timestamp(), len(y)) + x.tobytes() + y.tobytes()
+    return TRACE, rec.channel, frame(TRACE, rec.channel, flags, payload)
+
+
+def decode(kind, channel, flags, payload: bytes) -> Record:
+    """Rebuild a pipeline record from a frame."""
+    record = bool(flags & RECORDING)
+    if kind == MARKER:
+        time, freq = PAIR.unpack(payload)
+        return Marker(dt.datetime.fromtimestamp(time), freq, record=record, channel=channel)
+    if kind == GAP:
+        start, end = PAIR.unpack(payload)
+        return Gap(dt.datetime.fromtimestamp(start), dt.datetime.fromtimestamp(end), record=record)
+    if kind == TRACE:
+        time, n = TRACE_HEAD.unpack_from(payload)
+        offset = TRACE_HEAD.size
+        if len(payload) != offset + 12 * n:
+            raise ValueError(f"Trace frame of {len(payload)} bytes does not hold {n} points.")
+        x = np.frombuffer(payload, dtype='<f8', count=n, offset=offset)
+        y = np.frombuffer(payload, dtype='<f4', count=n, offset=offset + 8 * n)
+        return Trace(dt.datetime.fromtimestamp(time), x, y, record=record, channel=channel)
+    raise ValueError(f"Unknown frame kind {kind}.")
+
+
+##################
+#### Server
+##################
+
+
+class Subscriber():
+    """Backlog of one connected reader."""
+    def __init__(self, writer: asyncio.StreamWriter, backlog: int):
+        self.writer = writer
+        self.markers = collections.deque()  # marker and gap frames, in order
+        self.traces = {}  # channel -> latest trace frame
+        self.backlog = backlog
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.coalesced = 0
+        self.task = None
+
+    def offer(self, kind, channel, data):
+        """Queue a frame. Returns False if the reader has fallen too far behind."""
+        if kind == TRACE:
+            if channel in self.traces:
+                self.coalesced += 1
+            self.traces[channel] = data
+        else:
+            if len(self.markers) >= self.backlog:
+                return False
+            self.markers.append(data)
+        self.ready.set()
+        return True
+
+    def abort(self):
+        """Disconnect at once, discarding the backlog."""
+        self.closed = True
+        self.ready.set()
+        self.writer.transport.abort()
+
+    async def send(self):
+        """Write queued frames until the connection closes."""
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                if self.closed:
+                    break
+                frames = list(self.markers)
+                self.markers.clear()
+                frames.extend(self.traces.values())
+                self.traces.clear()
+                self.writer.write(b"".join(frames))
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            self.writer.close()
+
+
+class StreamServer(Sink):
+    """
+    Pipeline sink serving live data to any number of readers.
+    The server runs an asyncio loop on its own thread; frames are encoded
+    in the subscription thread and handed to the loop in batches.
+    """
+    types = (Marker, Trace, Gap)
+    batch_size = 100
+    maxsize = 1000
+
+    def __init__(self, address=DEFAULT_ADDRESS, backlog=10000):
+        self.address = address
+        self.backlog = backlog  # marker frames queued per reader before disconnecting it
+        self.subscribers = set()
+        self.connected = set()  # readers not yet disconnected, including dropped ones
+        self.dropped = 0  # readers disconnected for being too slow
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.server = None
+        self.thread = threading.Thread(target=self.serve, name="StreamServer", daemon=True)
+        self.thread.start()
+        self.started.wait(5)
+
+    def serve(self):
+        """Run the event loop."""
+        asyncio.set_event_loop(self.loop)
+        kind, where = parse_address(self.address)
+        try:
+            if kind == "unix":
+                start = asyncio.start_unix_server(self.handle, path=where)
+            else:
+                start = asyncio.start_server(self.handle, *where)
+            self.server = self.loop.run_until_complete(start)
+        except OSError as err:
+            print(f"Could not start stream server on {self.address}: {err}")
+            return
+        finally:
+            self.started.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def handle(self, reader, writer):
+        """Serve one reader."""
+        sub = Subscriber(writer, self.backlog)
+        sub.task = asyncio.current_task()
+        sub.markers.append(frame(HELLO, 0, 0, MAGIC))
+        sub.ready.set()
+        self.subscribers.add(sub)
+        self.connected.add(sub)
+        try:
+            await sub.send()
+        finally:
+            self.subscribers.discard(sub)
+            self.connected.discard(sub)
+
+    def dispatch(self, frames):
+        """Hand frames to every reader. Runs in the loop."""
+        for sub in list(self.subscribers):
+            for kind, channel, data in frames:
+                if not sub.offer(kind, channel, data):
+                    self.dropped += 1
+                    sub.abort()
+                    self.subscribers.discard(sub)
+                    break
+
+    def consume(self, records):
+        if not self.subscribers or not self.loop.is_running():
+            return
+        frames = [encode(rec) for rec in records if streamable(rec)]
+        self.loop.call_soon_threadsafe(self.dispatch, frames)
+
+    async def shutdown(self):
+        """Disconnect all readers and stop serving."""
+        self.server.close()
+        for sub in list(self.subscribers):
+            sub.abort()
+        await asyncio.gather(*(sub.task for sub in self.connected), return_exceptions=True)
+        await self.server.wait_closed()
+
+    def close(self):
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(5)
+
+
+##################
+#### Client
+##################
+
+
+class StreamClient():
+    """
+    Blocking reader of a stream server.
+
+        with StreamClient("tcp://127.0.0.1:5555") as client:
+            for rec in client:
+                print(rec.time, rec.freq)
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        kind, where = parse_address(address)
+        family = socket.AF_UNIX if kind == "unix" else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(where)
+        self.file = self.sock.makefile("rb")
+        kind, _, _, payload = self.read_frame()
+        if kind != HELLO or payload != MAGIC:
+            raise ConnectionError(f"{address} is not a QCM stream server.")
+
+    def read_frame(self) -> Tuple[int, int, int, bytes]:
+        """Next raw frame as (kind, channel, flags, payload)."""
+        header = self.file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise EOFError("Stream closed.")
+        kind, channel, flags, length = HEADER.unpack(header)
+        payload = self.file.read(length)
+        if len(payload) < length:
+            raise EOFError("Stream closed.")
+        return kind, channel, flags, payload
+
+    def read(self) -> Record:
+        """Next record."""
+        return decode(*self.read_frame())
+
+    def __iter__(self) -> Iterator[Record]:
+        try:
+            while True:
+                yield self.read()
+        except EOFError:
+            return
+
+    def close(self):
+        """Disconnect."""
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+##################
+#### Command line
+##################
+
+
+def listen(address):
+    """Print markers as they arrive."""
+    with StreamClient(address) as client:
+        for rec in client:
+            if isinstance(rec, Marker):
+                print(f"{rec.time.isoformat()},{rec.channel},{rec.freq}", flush=True)
+
+
+def bench(clients=4, points=601, seconds=5, rate=0, address="tcp://127.0.0.1:0"):
+    """Publish synthetic sweeps as fast as possible and measure delivery."""
+    server = StreamServer(address)
+    if server.server is None:
+        return
+    pipeline = Pipeline()
+    sub = pipeline.subscribe(server)
+    sockname = server.server.sockets[0].getsockname()
+    if isinstance(sockname, tuple):
+        address = f"tcp://{sockname[0]}:{sockname[1]}"
+
+    counts = [[0, 0, 0] for _ in range(clients)]  # markers, traces, bytes
+
+    def read(i):
+        with StreamClient(address) as client:
+            try:
+                while True:
+                    kind, _, _, payload = client.read_frame()
+                    counts[i][0 if kind == MARKER else 1] += 1
+                    counts[i][2] += len(payload) + HEADER.size
+            except (EOFError, OSError):
+                pass
+
+    readers = [threading.Thread(target=read, args=(i, ), daemon=True) for i in range(clients)]
+    for thread in readers:
+        thread.start()
+    while len(server.subscribers) < clients:
+        time.sleep(0.01)
+
+    x = np.linspace(9.92e6, 10.02e6, points)
+    y = np.random.default_rng().random(points)
+    sent = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        now = dt.datetime.now()
+        pipeline.publish(Marker(now, 9.97e6))
+        pipeline.publish(Trace(now, x, y))
+        sent += 1
+        if rate:
+            time.sleep(1 / rate)
+    elapsed = time.perf_counter() - start
+    pipeline.close()
+    time.sleep(0.5)
+
+    print(f"published {sent / elapsed:.0f} sweeps/s of {points} points to {clients} clients")
+    for i, (markers, traces, size) in enumerate(counts):
+        print(f"client {i}: {markers / elapsed:.0f} markers/s, {traces / elapsed:.0f} traces/s, "
+              f"{size / elapsed / 1e6:.1f} MB/s")
+    print(f"records dropped before the server: {sub.dropped}, slow readers dropped: {server.dropped}")
+
+
+def main():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description="QCM live data stream.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    cmd = sub.add_parser("listen", help="print live markers")
+    cmd.add_argument("address", nargs="?", default=DEFAULT_ADDRESS)
+    cmd = sub.add_parser("bench", help="measure server throughput")
+    cmd.add_argument("--clients", type=int, default=4)
+    cmd.add_argument("--points", type=int, default=601)
+    cmd.add_argument("--seconds", type=float, default=5)
+    cmd.add_argument("--rate", type=float, default=0, help="sweeps per second, 0 for maximum")
+    args = parser.parse_args()
+    if args.command == "listen":
+        listen(args.address)
+    else:
+        bench(args.clients, args.points, args.seconds, args.rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Adaptive zoom tracking of the resonance within a sweep window.
+"""
+from typing import Optional, Tuple
+
+from analysis import find_peak
+
+
+class ZoomTracker():
+    """
+    Narrow a window around the resonance and follow it as it drifts.
+
+    Starting from the wide range, the span is set to `factor` times the
+    resonance width (at least `min_span`) centred on the peak. The window
+    is re-centred when the peak moves more than `recentre` of the span from
+    the centre, resized when the width changes by more than a factor of two
+    and widened back to the full range when the peak is lost.
+    """
+    def __init__(self, start: float, stop: float, factor=10, min_span=5000, recentre=0.2):
+        self.wide = (start, stop)
+        self.span = self.wide
+        self.factor = factor
+        self.min_span = min_span
+        self.recentre = recentre
+        self.lost = False
+
+    def update(self, x, y) -> Optional[Tuple[float, float]]:
+        """Analyse a sweep and return a new (start, stop), if one is needed."""
+        peak = find_peak(x, y)
+        if peak is None:
+            self.lost = True
+            if self.span != self.wide:
+                self.span = self.wide
+                return self.span
+            return None
+        self.lost = False
+
+        start, stop = self.span
+        span = stop - start
+        target = min(max(self.factor * peak.width, self.min_span), self.wide[1] - self.wide[0])
+        if abs(peak.freq - (start + stop) / 2) > self.recentre * span \
+                or not 0.5 < target / span < 2:
+            self.span = (peak.freq - target / 2, peak.freq + target / 2)
+            return self.span
+        return None
@@ -0,0 +1,84 @@
+"""
+Event-triggered trace recording: sweeps are kept in memory and only saved
+at full rate around sudden changes of the resonance frequency, such as a
+gas switch or an adsorption step.
+"""
+import collections
+from typing import Deque, Dict, List, Optional, Tuple
+
+from pipeline import Marker, Trace
+
+
+class TraceTrigger():
+    """
+    Watch markers for a step or slope of the resonance frequency and decide
+    which sweeps to save around it.
+
+    The last `pre` sweeps of each harmonic are kept in a ring. A trigger
+    fires when the frequency moves by more than `step` Hz between two
+    markers, or changes faster than `slope` Hz/s over the last `span`
+    seconds (a threshold of 0 is disabled). The ring is then handed over
+    for saving, followed by the next `post` sweeps. A new trigger during
+    that time extends it.
+    """
+    def __init__(self, pre=20, post=100, slope=0, step=0, span=5):
+        self.pre = int(pre)
+        self.post = int(post)
+        self.slope = float(slope)  # Hz/s
+        self.step = float(step)  # Hz
+        self.span = float(span)  # s over which the slope is measured
+        self.history: Dict[int, Deque[Tuple[object, float]]] = {}  # channel -> (time, freq)
+        self.rings: Dict[int, Deque[Trace]] = {}  # channel -> sweeps before a trigger
+        self.remaining: Dict[int, int] = {}  # channel -> sweeps still to save after a trigger
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any threshold is set."""
+        return self.slope > 0 or self.step > 0
+
+    def reset(self):
+        """Forget all markers and buffered sweeps."""
+        self.history.clear()
+        self.rings.clear()
+        self.remaining.clear()
+
+    def check(self, rec: Marker) -> Optional[str]:
+        """Add a marker, returning why it triggers, if it does."""
+        history = self.history.setdefault(rec.channel, collections.deque())
+        while history and (rec.time - history[0][0]).total_seconds() > self.span:
+            history.popleft()
+        reason = None
+        if history:
+            change = rec.freq - history[-1][1]
+            elapsed = (rec.time - history[0][0]).total_seconds()
+            slope = (rec.freq - history[0][1]) / elapsed if elapsed > 0 else 0
+            if self.step > 0 and abs(change) > self.step:
+                reason = f"step of {change:+.1f} Hz on harmonic {rec.channel}"
+            elif self.slope > 0 and len(history) > 1 and abs(slope) > self.slope:
+                reason = f"slope of {slope:+.2f} Hz/s on harmonic {rec.channel}"
+        history.append((rec.time, rec.freq))
+        return reason
+
+    def fire(self) -> List[Trace]:
+        """Start saving every sweep, returning the buffered ones in time order."""
+        for channel in set(self.rings) | set(self.history):
+            self.remaining[channel] = self.post
+        buffered = [rec for ring in self.rings.values() for rec in ring]
+        self.rings.clear()
+        return sorted(buffered, key=lambda rec: rec.time)
+
+    def keep(self, rec: Trace) -> bool:
+        """Whether a sweep follows a trigger and should be saved."""
+        remaining = self.remaining.get(rec.channel, 0)
+        if remaining > 0:
+            self.remaining[rec.channel] = remaining - 1
+            return True
+        return False
+
+    def buffer(self, rec: Trace):
+        """Keep a sweep which was not saved, in case a trigger follows."""
+        if self.pre > 0:
+            ring = self.rings.get(rec.channel)
+            if ring is None:
+                ring = self.rings[rec.channel] = collections.deque(maxlen=self.pre)
+            ring.append(rec)
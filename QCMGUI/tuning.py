@@ -0,0 +1,140 @@
+"""
+Sweep parameter tuning: find the fastest instrument setting which still
+resolves the resonance to a required frequency noise.
+
+Candidate combinations of resolution bandwidth, video bandwidth, point
+count and span are applied in turn around the resonance. For each, a few
+sweeps are taken to measure the real sweep time and the scatter of the
+peak frequency. The fastest candidate within the target becomes a profile,
+saved in the settings as `profile_<name> = rbw=...,vbw=...,span=...`.
+"""
+import itertools
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from analysis import find_peak
+
+RBW = (300, 1000, 3000, 10000)  # Hz
+VBW = (1000, 100000, 1000000)  # Hz
+POINTS = (201, 501, 1001, 2001)
+SPANS = (1, 0.3, 0.1)  # fractions of the configured span
+MAX_SWEEP = 10  # s, slower candidates are abandoned after one sweep
+
+
+class Candidate(NamedTuple):
+    """Sweep settings to try. Parameters the instrument cannot set are None."""
+    rbw: Optional[float]
+    vbw: Optional[float]
+    points: Optional[int]
+    span: float
+
+    def profile(self) -> Dict[str, float]:
+        """Instrument profile of the settings, without the span."""
+        return {
+            key: value
+            for key, value in self._asdict().items() if key != "span" and value is not None
+        }
+
+
+class Benchmark(NamedTuple):
+    """Measured performance of a candidate."""
+    candidate: Candidate
+    sweep_time: float  # s, median per sweep including transfer
+    noise: float  # Hz, standard deviation of the peak frequency
+
+
+def candidates(tunable, span, rbw=RBW, vbw=VBW, points=POINTS, spans=SPANS) -> List[Candidate]:
+    """All combinations of the parameters an instrument can tune."""
+    rbw = rbw if "rbw" in tunable else (None, )
+    vbw = vbw if "vbw" in tunable else (None, )
+    points = points if "points" in tunable else (None, )
+    return [
+        Candidate(r, v, p, span * s) for r, v, p, s in itertools.product(rbw, vbw, points, spans)
+        if r is None or v is None or v >= r  # VBW below RBW only slows the sweep
+    ]
+
+
+def format_profile(profile: Dict[str, float]) -> str:
+    """Profile as a settings value."""
+    return ",".join(f"{key}={value:g}" for key, value in profile.items() if value is not None)
+
+
+def parse_profile(value: str) -> Dict[str, float]:
+    """Profile from a settings value."""
+    profile = {}
+    for item in value.split(","):
+        key, _, val = item.partition("=")
+        if key.strip():
+            profile[key.strip()] = int(val) if key.strip() == "points" else float(val)
+    return profile
+
+
+class SweepTuner():
+    """Benchmark candidates on a connected instrument, with the session locked."""
+    def __init__(self, model, target: float, sweeps=5):
+        self.model = model
+        self.target = target  # Hz of peak frequency noise
+        self.sweeps = sweeps
+        self.centre = None  # resonance frequency found before tuning
+
+    def sweep(self):
+        """Take one sweep, returning its duration and the fitted peak."""
+        start = time.perf_counter()
+        self.model.trigger()
+        _, trace = self.model.acquire()
+        elapsed = time.perf_counter() - start
+        peak = find_peak(self.model.frange, trace) if trace is not None else None
+        return elapsed, peak
+
+    def locate(self, start: float, stop: float) -> Optional[float]:
+        """Resonance frequency within a range, with the current profile."""
+        model = self.model
+        model.state.apply(model.instrument, model.settings(start, stop))
+        model.configured(start, stop)
+        _, peak = self.sweep()
+        return peak.freq if peak else None
+
+    def measure(self, centre: float, candidate: Candidate) -> Benchmark:
+        """Apply a candidate and time a few sweeps."""
+        model = self.model
+        start, stop = centre - candidate.span / 2, centre + candidate.span / 2
+        model.profile = candidate.profile()
+        model.state.apply(model.instrument, model.settings(start, stop))
+        model.configured(start, stop)
+
+        times = []
+        freqs = []
+        for _ in range(self.sweeps):
+            elapsed, peak = self.sweep()
+            times.append(elapsed)
+            freqs.append(peak.freq if peak else np.nan)
+            if elapsed > MAX_SWEEP:
+                break
+        noise = float(np.std(freqs)) if len(freqs) > 1 else np.nan
+        return Benchmark(candidate, float(np.median(times)), noise)
+
+    def run(self, start: float, stop: float, candidates: List[Candidate]) -> List[Benchmark]:
+        """Benchmark all candidates around the resonance found between start and stop."""
+        model = self.model
+        model.continuous(False)
+        self.centre = self.locate(start, stop)
+        if self.centre is None:
+            model.log("Tuning needs a clear resonance in the configured range.")
+            return []
+
+        results = []
+        for i, candidate in enumerate(candidates):
+            result = self.measure(self.centre, candidate)
+            results.append(result)
+            model.log(
+                f"Tuning {i + 1}/{len(candidates)}: {format_profile(candidate._asdict())} -> "
+                f"{result.sweep_time * 1000:.0f} ms, {result.noise:.2f} Hz"
+            )
+        return results
+
+    def best(self, results: List[Benchmark]) -> Optional[Benchmark]:
+        """Fastest candidate meeting the target."""
+        passing = [r for r in results if r.noise <= self.target]  # nan never passes
+        return min(passing, key=lambda r: r.sweep_time) if passing else None
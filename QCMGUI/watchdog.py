@@ -0,0 +1,98 @@
+"""
+Connection supervisor which detects a failed instrument session and
+restores it in the background.
+"""
+import datetime as dt
+import threading
+
+from pipeline import Gap
+
+
+class ConnectionSupervisor(threading.Thread):
+    """
+    Watch the instrument session and bring it back when it fails.
+
+    The measurement loop reports failures and pauses while the session is
+    offline. The supervisor then confirms with a short health check,
+    reconnects with exponential backoff, restores the last configuration and
+    publishes the outage as a `Gap`. Measurement and recording resume on
+    their own since their flags are never cleared.
+    """
+    def __init__(self, model, check_timeout=500, check_interval=5, backoff=(1, 30)):
+        super().__init__(daemon=True)
+        self.name = "ConnectionSupervisor"
+        self.model = model
+        self.check_timeout = check_timeout  # ms allowed for a health check
+        self.check_interval = check_interval  # s between idle health checks
+        self.backoff = backoff  # min/max s between reconnection attempts
+
+        self.online = threading.Event()  # set while the session is usable
+        self.failed = threading.Event()  # set when a failure is reported
+        self.gap_start = None
+
+    def report(self, err):
+        """Called on a communication error. Pauses use of the session."""
+        if self.online.is_set():
+            self.online.clear()
+            self.gap_start = dt.datetime.now()
+            self.model.log(f"Instrument communication failed: {err}")
+            self.failed.set()
+
+    def healthy(self) -> bool:
+        """Query the instrument with a short timeout."""
+        inst = self.model.instrument
+        if inst is None:
+            return False
+        with self.model.lock:
+            timeout = inst.timeout
+            try:
+                inst.timeout = self.check_timeout
+                inst.query("*OPC?")
+                return True
+            except Exception:
+                return False
+            finally:
+                try:
+                    inst.timeout = timeout
+                except Exception:
+                    pass
+
+    def stopping(self):
+        """Whether the program is closing."""
+        return self.model.quit_event is not None and self.model.quit_event.is_set()
+
+    def run(self):
+        """Supervision loop."""
+        while not self.stopping():
+            if self.failed.wait(self.check_interval):
+                self.recover()
+            elif self.online.is_set() and not self.model.thread_measure_flag:
+                # idle: catch dead sessions before the user needs them
+                if not self.healthy():
+                    self.report("health check timed out")
+
+    def recover(self):
+        """Reconnect until successful, then restore configuration."""
+        if self.healthy():
+            self.model.log("Instrument responding again.")
+        else:
+            delay = self.backoff[0]
+            while not self.stopping():
+                self.model.log("Attempting to reconnect...")
+                try:
+                    self.model.reopen()
+                    self.model.restore()
+                    break
+                except Exception as err:
+                    self.model.log(f"Reconnection failed ({err}), retrying in {delay} s.")
+                    self.model.quit_event.wait(delay)
+                    delay = min(2 * delay, self.backoff[1])
+            else:
+                return
+
+        self.model.publish(
+            Gap(self.gap_start, dt.datetime.now(), record=self.model.thread_record_flag)
+        )
+        self.model.log("Connection restored.")
+        self.failed.clear()
+        self.online.set()